@@ -14,13 +14,21 @@ import sys
 import os.path
 from functools import wraps
 import socket
-from flask import Flask, request, session, render_template
+from flask import Flask, Response, request, session, render_template, g
 from flask_wtf import FlaskForm
 from wtforms import StringField
 import requests
 import json
 import datetime as date
+import random
+import secrets
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
 import bc0lib as bc
+import bc0outbox
+import bc0metrics as metrics
 
 IPAddr = socket.gethostbyname(socket.gethostname())
 
@@ -41,6 +49,32 @@ print('*** from host: ' + IPAddr)
 
 app = Flask(__name__, template_folder=template_folder)
 app.config['SECRET_KEY'] = 'abcabcabc'
+app.config['BC0_CHECKPOINT_KEY'] = os.environ.get('BC0_CHECKPOINT_KEY')    # key signing the checkpoints (a random key of this host if None)
+app.config['BC0_VERIFY_WORKERS'] = bc.VERIFY_WORKERS         # processes verifying a chain
+app.config['BC0_VERIFY_CHUNK_SIZE'] = bc.VERIFY_CHUNK_SIZE   # blocks verified by a process at a time
+app.config['BC0_PEER_TIMEOUT'] = 1.0        # seconds to wait for a single request to a peer
+app.config['BC0_FANOUT_DEADLINE'] = 2.0     # seconds to wait for the requests to all the peers
+app.config['BC0_FANOUT_WORKERS'] = 16       # requests sent to the peers at the same time
+app.config['BC0_ASYNC_REPLICATION'] = True  # send the updates to the peers from a background outbox
+app.config['BC0_GOSSIP'] = False            # send the updates to a random subset of the peers, which forward them
+app.config['BC0_GOSSIP_FANOUT'] = 6         # peers an update is sent or forwarded to, in gossip mode
+app.config['BC0_SYNC_TIMEOUT'] = 10.0       # seconds to wait for the next data of a chain being downloaded, and for a range of its blocks
+app.config['BC0_SYNC_BATCH'] = 1000         # downloaded blocks written to the local chain at a time
+app.config['BC0_SYNC_SOURCES'] = 4          # peers a chain is downloaded from at the same time
+app.config['BC0_SYNC_FROM_CHECKPOINT'] = False  # download a new chain from the last checkpoint of the host, without the previous history
+app.config['BC0_SEAL_MAX_ITEMS'] = bc.SEAL_MAX_ITEMS    # pending data items that trigger sealing a block
+app.config['BC0_SEAL_MAX_BYTES'] = bc.SEAL_MAX_BYTES    # size of the pending data items that triggers sealing a block
+app.config['BC0_SEAL_MAX_AGE'] = bc.SEAL_MAX_AGE        # age of the oldest pending data item that triggers sealing a block
+app.config['BC0_COMMIT_WINDOW'] = bc.COMMIT_WINDOW      # seconds for which concurrent data for the same chain are gathered
+app.config['BC0_COMMIT_MAX_BATCH'] = bc.COMMIT_MAX_BATCH    # data gathered beyond which they are committed without waiting
+app.config['BC0_CACHE_BUDGET'] = bc.CACHE_BUDGET        # bytes of memory for the chains and host lists kept loaded
+app.config['BC0_PAGE_SIZE'] = 20            # blocks shown in a page of the content of a chain
+app.config['BC0_LOG_FORMAT'] = bc.FORMAT_JSON   # format of the local block logs (json or bin)
+app.config['BC0_WIRE_FORMAT'] = bc.FORMAT_JSON  # format of the blocks sent to the peers (json or bin)
+app.config['BC0_IO_WORKERS'] = 64          # threads doing the file work of the peer endpoints (asynchronous mode)
+app.config['BC0_UI_WORKERS'] = 32          # threads serving the other requests with the flask app (asynchronous mode)
+app.config['BC0_PEER_CONNECTIONS'] = 1000   # connections to the peers open at the same time (asynchronous mode)
+BIN_MIMETYPE = 'application/x-bc0'      # the binary format of blocks
 
 
 class IdForm(FlaskForm):
@@ -53,6 +87,33 @@ class WorkForm(FlaskForm):
     data = StringField('data')
 
 
+cache = bc.FileCache(app.config['BC0_CACHE_BUDGET'])    # the loaded chains and host lists
+
+REQUEST_SECONDS = metrics.REGISTRY.histogram('bc0_request_seconds', 'Duration of the requests served, by route.', ('route', 'method', 'status'))
+PEER_SECONDS = metrics.REGISTRY.histogram('bc0_peer_request_seconds', 'Duration of the requests sent to the peers.', ('peer', 'req'))
+PEER_ERRORS = metrics.REGISTRY.counter('bc0_peer_errors_total', 'Failed requests sent to the peers.', ('peer', 'req'))
+CACHE_STATS = metrics.REGISTRY.gauge('bc0_cache', 'Counters of the cache of the loaded chains and host lists.', ('stat',))
+COMMIT_STATS = metrics.REGISTRY.gauge('bc0_group_commit', 'Commits of groups of concurrent data, and data committed.', ('stat',))
+OUTBOX_DEPTH = metrics.REGISTRY.gauge('bc0_outbox_depth', 'Updates waiting to be sent to a peer.', ('peer',))
+PEER_RTT = metrics.REGISTRY.gauge('bc0_peer_rtt_seconds', 'Smoothed latency of a peer, as measured by the probes.', ('peer',))
+PEER_FAILURES = metrics.REGISTRY.gauge('bc0_peer_failures', 'Consecutive failed requests to a peer.', ('peer',))
+OUTBOX_LAG = metrics.REGISTRY.gauge('bc0_outbox_lag_seconds', 'Age of the oldest update waiting to be sent to a peer.', ('peer',))
+
+
+@app.before_request
+def start_timer():
+    """Take the time a request starts being served."""
+    g.start = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    """Record the duration of a request (for a streamed response, until the stream starts)."""
+    if 'start' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        REQUEST_SECONDS.observe(time.perf_counter() - g.start, route=route, method=request.method, status=response.status_code)
+    return response
+
+
 # Helper (local) functions **************************************
 def not_given(name):
     return name is None or len(name) == 0
@@ -65,6 +126,7 @@ def h_read_file(filename, jsoned=False):
     try:
         with open(filename, 'r') as fin:
             data = fin.read()
+            bc.count_read(filename, len(data))
             res = {'code': '0', 'data': data}   # ok
             return res if not jsoned else json.dumps(res)
     except:
@@ -77,6 +139,8 @@ def h_write_file(filename, data):
     try:
         with open(filename, 'w') as fout:
             print(data, file=fout)
+        bc.count_written(filename, len(data) + 1)
+        cache.invalidate(filename)
         return '0'      # ok
     except:
         return '-2'     # ko:  problems in writing the file
@@ -86,24 +150,124 @@ def h_delete_file(filename):
     if not_given(filename): return "-1"       # ko: missing filename
     try:
         os.remove(filename)
+        cache.invalidate(filename)
         return "0"      # ok
     except:
         return '-2'     # ko:  problems in deleting the file
 
+def h_open_chain(filename):
+    """Open a (local) blockchain from its block log."""
+    if not_given(filename):
+        return {'code': '-1'}      # ko: missing filename
+    if not os.path.isfile(filename):
+        return {'code': '-1'}      # ko: missing file
+    try:
+        if os.path.getsize(filename) * cache.overhead > cache.budget:   # too big to be loaded: a lazy view
+            return {'code': '0', 'data': bc.Blockchain.open(filename, lazy=True)}   # ok
+        return {'code': '0', 'data': cache.get(filename, bc.Blockchain.open, bc.Blockchain.refresh)}   # ok
+    except:
+        return {'code': '-2'}      # ko: problems in reading the block log
+
+def h_open_index(filename):
+    """Open the query index of a (local) blockchain, building it if missing."""
+    if not_given(filename):
+        return {'code': '-1'}      # ko: missing filename
+    if not os.path.isfile(filename):
+        return {'code': '-1'}      # ko: missing file
+    try:
+        with get_chain_lock(filename):      # the index file is written while catching up with the chain
+            if not os.path.isfile(filename + bc.QUERY_SUFFIX):
+                cache.put(filename + bc.QUERY_SUFFIX, bc.ItemIndex.open(filename))
+            return {'code': '0', 'data': cache.get(filename + bc.QUERY_SUFFIX, lambda path: bc.ItemIndex.open(filename), bc.ItemIndex.refresh)}   # ok
+    except:
+        return {'code': '-2'}      # ko: problems in reading the block log
+
+def h_save_chain(filename, chain):
+    """Write a (local) blockchain as a new block log (under the lock of the chain)."""
+    if not_given(filename): return "-1"       # ko: missing filename
+    try:
+        cache.invalidate(filename)
+        chain.save(filename, app.config['BC0_LOG_FORMAT'])
+        cache.put(filename, chain)
+        return '0'      # ok
+    except:
+        return '-2'     # ko:  problems in writing the block log
+
+def h_append_blocks(chain, height, parent, blocks):
+    """Append blocks to a (local) blockchain, if they follow its last block."""
+    num_blocks = chain.get_num_blocks()
+    if height > num_blocks: return {'code': '-3', 'from': num_blocks}     # ko: some blocks are missing
+    if height <= chain.base or chain.get_block(height - 1).hash_me() != parent:
+        return {'code': '-4'}      # ko: the blocks do not follow the local chain
+    try:
+        for i, block in enumerate(blocks):
+            if block.index != height + i: return {'code': '-4'}
+            block.hash_version = chain.hash_version
+            if block.index < num_blocks:    # already there
+                if block.hash_me() != chain.get_block(block.index).hash_me(): return {'code': '-4'}
+                continue
+            if block.previous_hash != chain.get_block(block.index - 1).hash_me(): return {'code': '-4'}
+            chain.append_block(block)
+    except:
+        return {'code': '-2'}      # ko: problems in appending the blocks
+    return {'code': '0', 'added': chain.get_num_blocks() - num_blocks}     # ok
+
+def h_delete_chain(filename):
+    """Delete a (local) blockchain, with all the files storing it."""
+    if not_given(filename): return "-1"       # ko: missing filename
+    with get_chain_lock(filename):
+        res = h_delete_file(filename)
+        for f in bc.chain_files(filename)[1:]:
+            if os.path.isfile(f): h_delete_file(f)
+    return res
+
+def migrate_chain_files():
+    """Convert the legacy single-JSON chain files in the app folder into block logs."""
+    for f in os.listdir(app_folder):
+        if f.endswith('_chain'):
+            try:
+                if bc.migrate_chain_file(app_folder + '/' + f, app.config['BC0_LOG_FORMAT']): print('*** Migrated to a block log: ' + f)
+            except:
+                print('*** Unable to migrate to a block log: ' + f)
+
 def adapt_to_win(bc_host):
     return bc_host.replace(":", "_")
 
+def load_host_list(filename):
+    """Read the list of hosts in a (local) file."""
+    with open(filename, 'r') as fin:
+        data = fin.read()
+        data = json.loads(data)
+        return data['hosts']
+
+def load_members(filename):
+    """Read the membership of the hosts in a (local) file, as host -> [version, present],
+    each host changing (by entering or leaving the chain) only its own entry."""
+    with open(filename, 'r') as fin:
+        data = json.loads(fin.read())
+    return data.get('members', {h: [0, True] for h in data['hosts']})
+
+def merge_members(members, delta):
+    """Merge a membership delta into a membership, keeping the newest version of each entry;
+    Return the entries which have changed."""
+    changed = {}
+    for h, entry in delta.items():
+        if h not in members or entry[0] > members[h][0]:
+            members[h] = changed[h] = entry
+    return changed
+
+def hosts_data(members):
+    """Get the content of a hosts file from a membership."""
+    return {'hosts': sorted(h for h, (_, present) in members.items() if present), 'members': members}
+
 def get_host_list(bc_name, bc_host):
     """Get the list of hosts maintaining this blockchain."""
     filename = app_folder + '/' + bc_name + '_' + adapt_to_win(bc_host) + '_hosts'
     if not os.path.isfile(filename):
         return {'code': '-1'}      # ko: missing filename
     try:
-        with open(filename, 'r') as fin:
-            data = fin.read()
-            data = json.loads(data)
-            data = data['hosts']
-        return {'code': '0', 'data': data}     # ok
+        data = cache.get(filename, load_host_list)
+        return {'code': '0', 'data': list(data)}     # ok
     except:
         return {'code': '-2'}      # ko: problems in getting the file
 
@@ -124,9 +288,37 @@ def t_bad_list(res, filename, bcname):
     if res['code'] == '-1': return render_template(x, hostid=hostid, userid=session['userid'], bcname=bcname, msg="The blockchain '" + bcname + "' does not exist.")
     if res['code'] == '-2': return render_template(x, hostid=hostid, userid=session['userid'], bcname=bcname, msg="Problems in getting data from the blockchain file '" + filename + "'.")
 
+def chain_page(chain, page=0, size=None, first=None, last=None, newest_first=True):
+    """Get a page of the blocks of a chain in a range [first, last) of heights,
+    the newest first unless specified otherwise, reading only those blocks."""
+    size = max(1, size or app.config['BC0_PAGE_SIZE'])
+    num_blocks = chain.get_num_blocks()
+    first = chain.base if first is None else min(max(first, chain.base), num_blocks)
+    last = num_blocks if last is None else min(max(last, first), num_blocks)
+    if newest_first:
+        heights = range(last - 1 - page * size, max(first, last - (page + 1) * size) - 1, -1)
+    else:
+        heights = range(first + page * size, min(last, first + (page + 1) * size))
+    blocks = []
+    for i in heights:
+        block = chain.get_block(i)
+        blocks.append(dict(block.dump_me(), index=i, hash=block.hash_me()))
+    return {'name': chain.name, 'num_blocks': num_blocks, 'from': first, 'to': last, 'order': 'newest' if newest_first else 'oldest',
+            'page': page, 'size': size, 'pages': (last - first + size - 1) // size, 'blocks': blocks}
+
+def chain_etag(filename, *params):
+    """Get the entity tag of a view of a chain, changing when the chain file changes."""
+    st = os.stat(filename)
+    return '%x-%x-%x-%x' % (st.st_ino, st.st_mtime_ns, st.st_size, zlib.crc32(repr(params).encode('utf-8')))
+
 def t_default(bcname='', bchost='', msg=''):
     return render_template(x, hostid=hostid, userid=session['userid'], bcname=bcname, bchost=bchost, msg=msg)
 
+def read_int(values, name, default=None):
+    """Read an integer argument of a request, or the default if missing; raise ValueError if not an integer."""
+    value = values.get(name)
+    return default if value is None or value == '' else int(value)
+
 def read_form(with_host=False, with_data=False):
     WorkForm(request.form)
     bc_name = request.form['name']
@@ -134,67 +326,647 @@ def read_form(with_host=False, with_data=False):
     if with_data: return bc_name, request.form['data']
     return bc_name
 
-def send_http_req(host, req, data):
-    headers = {'content-type': 'application/json'}
+peer_sessions = {}      # a keep-alive session for each peer
+peer_sessions_lock = threading.Lock()
+fanout_pool = ThreadPoolExecutor(max_workers=app.config['BC0_FANOUT_WORKERS'])
+
+def get_peer_session(host):
+    """Get the session reusing the connections to a peer."""
+    with peer_sessions_lock:
+        if host not in peer_sessions:
+            peer_sessions[host] = requests.Session()
+        return peer_sessions[host]
+
+def send_http_req(host, req, data, content_type='application/json'):
+    headers = {'content-type': content_type}
     url = 'http://' + host + req
     print('Sending an update request to ' + host + '...')
-    req = requests.post(url, data=json.dumps(data), headers=headers, timeout=1.0)
-    req.raise_for_status()
-
-def send_http_req_to_all_hosts(bc_name, bc_host, host_list, act_name, act_desc, data):
+    if content_type == 'application/json': data = json.dumps(data)
+    start = time.perf_counter()
+    try:
+        res = get_peer_session(host).post(url, data=data, headers=headers, timeout=app.config['BC0_PEER_TIMEOUT'])
+        res.raise_for_status()
+    except Exception:
+        PEER_ERRORS.inc(peer=host, req=req)
+        raise
+    finally:
+        PEER_SECONDS.observe(time.perf_counter() - start, peer=host, req=req)
+    return res.text
+
+def blocks_to_send(chain, height):
+    """Get the request data to send the blocks of a chain from the specified height."""
+    blocks = [chain.get_block(i).write_me(jsoned=True) for i in range(height, chain.get_num_blocks())]
+    return {'name': chain.name, 'height': height, 'parent': chain.get_block(height - 1).hash_me(), 'blocks': blocks}
+
+def blocks_to_pack(chain, height):
+    """Get the request data to send the blocks of a chain from the specified height, in the binary format."""
+    header = {'name': chain.name, 'height': height, 'parent': chain.get_block(height - 1).hash_me(), 'fmt': bc.FORMAT_BIN}
+    blocks = [chain.get_block(i).pack_me() for i in range(height, chain.get_num_blocks())]
+    return (json.dumps(header) + '\n').encode('utf-8') + b''.join(blocks)
+
+def post_blocks(host, req, chain, height):
+    """Send the blocks of a chain from the specified height to a host, in the
+    binary format if so configured and if the host understands it."""
+    if app.config['BC0_WIRE_FORMAT'] == bc.FORMAT_BIN:
+        try:
+            return send_http_req(host, req, blocks_to_pack(chain, height), BIN_MIMETYPE)
+        except requests.HTTPError:
+            pass    # the host does not understand the binary format
+    return send_http_req(host, req, blocks_to_send(chain, height))
+
+def send_blocks(host, req, data, chain=None):
+    """Send the blocks of a chain from the height in the data to a host, then
+    the blocks it misses if it is behind, or the whole chain if the blocks do
+    not fit its chain; the chain is read from its file if not specified (or
+    if the blocks to send have not been loaded)."""
+    if chain is None or chain.base >= data['height']:
+        res = h_open_chain(data['chain'])
+        if res['code'] != '0': return      # the chain has been deleted locally in the meantime
+        chain = res['data']
+    if data['height'] >= chain.get_num_blocks(): return
+    res = json.loads(post_blocks(host, req, chain, data['height']))
+    if res['code'] != '0' and chain.base > 0:
+        chain = h_open_chain(data['chain'])['data']     # older blocks are needed
+    if res['code'] == '-3' and chain.base < res['from'] < data['height']:     # ko: the host misses some blocks
+        res = json.loads(post_blocks(host, req, chain, res['from']))
+    if res['code'] != '0':
+        send_http_req(host, '/upgrade_chain', {'name': chain.name, 'data': chain.write_me(jsoned=True)})
+
+def deliver(host, req, data, chain=None):
+    """Send an update request to a host."""
+    if req == '/append_block': return send_blocks(host, req, data, chain)
+    return send_http_req(host, req, data)
+
+def deliver_ops(host, bc_name, ops):
+    """Send the updates queued in the outbox for a host and a chain."""
+    for req, data in ops:
+        deliver(host, req, data)
+
+peer_health = {}        # for each peer: smoothed latency in seconds (None if unknown) and consecutive failures
+peer_health_lock = threading.Lock()
+
+def record_peer(host, rtt=None):
+    """Record the latency of a request that a peer served, or a failure if no latency is specified."""
+    with peer_health_lock:
+        health = peer_health.setdefault(host, {'rtt': None, 'failures': 0})
+        if rtt is None:
+            health['failures'] += 1
+            return
+        health['rtt'] = rtt if health['rtt'] is None else 0.7 * health['rtt'] + 0.3 * rtt
+        health['failures'] = 0
+
+def rank_peers(hosts):
+    """Sort the peers from the healthiest and fastest."""
+    with peer_health_lock:
+        health = {h: peer_health.get(h, {'rtt': None, 'failures': 0}) for h in hosts}
+    return sorted(hosts, key=lambda h: (health[h]['failures'], float('inf') if health[h]['rtt'] is None else health[h]['rtt']))
+
+def probe_peer(host, bc_name):
+    """Get the number of blocks of a chain at a peer, recording the latency of the peer; Return None if the peer is not reachable."""
+    start = time.perf_counter()
+    try:
+        res = get_peer_session(host).get('http://' + host + '/get_blocks', params={'name': bc_name, 'from': 2 ** 62},
+                                         timeout=app.config['BC0_PEER_TIMEOUT'])
+        res.raise_for_status()
+        header = json.loads(res.text.split('\n', 1)[0])
+    except Exception:
+        record_peer(host)
+        return None
+    record_peer(host, time.perf_counter() - start)
+    return header['to']
+
+def fetch_blocks(host, bc_name, first, last=None):
+    """Download from a peer the blocks of a chain from first to last (excluded);
+    Return the header of the stream and a generator of the blocks."""
+    url = 'http://' + host + '/get_blocks'
+    params = {'name': bc_name, 'from': first}
+    if last is not None: params['to'] = last
+    accept = BIN_MIMETYPE if app.config['BC0_WIRE_FORMAT'] == bc.FORMAT_BIN else 'application/x-ndjson'
+    res = get_peer_session(host).get(url, params=params, headers={'Accept-Encoding': 'gzip', 'Accept': accept},
+                                     stream=True, timeout=(app.config['BC0_PEER_TIMEOUT'], app.config['BC0_SYNC_TIMEOUT']))
+    res.raise_for_status()
+    blocks = bc.read_blocks(res.iter_content(65536))
+    return next(blocks), blocks
+
+def fetch_range(host, bc_name, first, last, hash_version):
+    """Download from a peer the blocks of a chain from first to last (excluded),
+    checking that they are all there and linked to each other; Return the list of blocks."""
+    _, blocks = fetch_blocks(host, bc_name, first, last)
+    res = []
+    for block in blocks:
+        block.hash_version = hash_version
+        if block.index != first + len(res) or (len(res) > 0 and block.previous_hash != res[-1].hash_me()):
+            raise ValueError('block ' + str(block.index) + ' from ' + host + ' does not follow the previous one')
+        res.append(block)
+    if len(res) != last - first: raise ValueError(host + ' sent ' + str(len(res)) + ' blocks instead of ' + str(last - first))
+    return res
+
+def download_ranges(chain, sources, bc_name, last):
+    """Download the blocks of a chain up to last (excluded) from several peers in
+    parallel, a range of blocks at a time, so that faster peers send more ranges;
+    each range is appended to the local chain in order, if it follows it, or else
+    (or if the peer has not sent it within BC0_SYNC_TIMEOUT seconds) it is
+    downloaded again from another peer; Return the number of blocks of the local chain."""
+    size = app.config['BC0_SYNC_BATCH']
+    timeout = app.config['BC0_SYNC_TIMEOUT']
+    todo = list(range(chain.get_num_blocks(), last, size))      # the first heights of the ranges still to download
+    pending = {}        # first height -> (peer, start time) of the ranges being downloaded
+    done = {}           # first height -> (peer, blocks) of the ranges downloaded but not yet appended
+    failed = set()      # the peers which sent wrong blocks, were not reachable or too slow
+    state = {'finished': False}
+    cond = threading.Condition()
+
+    def fail(host, first):
+        """Mark a peer as failed and queue its range again (with the condition held)."""
+        record_peer(host)
+        failed.add(host)
+        pending.pop(first, None)
+        todo.append(first)
+        todo.sort()
+        cond.notify_all()
+
+    def worker(host):
+        while True:
+            with cond:
+                while not state['finished'] and host not in failed and (len(todo) == 0 or (len(done) >= 2 * len(sources) and todo[0] > min(done))):
+                    cond.wait()
+                if state['finished'] or host in failed: return
+                first = todo.pop(0)
+                pending[first] = (host, time.monotonic())
+            try:
+                blocks = fetch_range(host, bc_name, first, min(first + size, last), chain.hash_version)
+            except Exception:
+                blocks = None
+            with cond:
+                if pending.get(first, (None,))[0] != host: return     # too late: the range has been queued again
+                if blocks is None:
+                    fail(host, first)
+                    return
+                del pending[first]
+                done[first] = (host, blocks)
+                cond.notify_all()
+
+    pool = ThreadPoolExecutor(max_workers=len(sources))
+    for h in sources:
+        pool.submit(worker, h)
+    try:
+        while chain.get_num_blocks() < last:
+            first = chain.get_num_blocks()
+            with cond:
+                while first not in done:
+                    now = time.monotonic()
+                    for f, (h, start) in list(pending.items()):
+                        if now - start > timeout: fail(h, f)
+                    if len(failed) == len(sources): raise ValueError('no peer could send the blocks from ' + str(first))
+                    cond.wait(timeout=min([start + timeout - now for _, start in pending.values()] + [timeout]))
+                host, blocks = done.pop(first)
+                cond.notify_all()
+            if blocks[0].previous_hash != chain.get_block(first - 1).hash_me():
+                with cond:
+                    fail(host, first)
+                continue
+            chain.append_blocks(blocks)
+            chain.forget_blocks(chain.get_num_blocks() - 1)
+    finally:
+        with cond:
+            state['finished'] = True
+            cond.notify_all()
+        pool.shutdown(wait=False)
+    return chain.get_num_blocks()
+
+def start_download(bc_host, bc_name, filename):
+    """Create a local chain with its first block downloaded from a host: the
+    genesis block or, in BC0_SYNC_FROM_CHECKPOINT mode, the last block verified
+    by the host, so that the previous history is not downloaded; Return the chain."""
+    first, block_hash = 0, None
+    if app.config['BC0_SYNC_FROM_CHECKPOINT']:
+        try:
+            res = get_peer_session(bc_host).get('http://' + bc_host + '/get_checkpoint', params={'name': bc_name}, timeout=app.config['BC0_PEER_TIMEOUT'])
+            res.raise_for_status()
+            checkpoint = json.loads(res.text)
+            if checkpoint['code'] == '0': first, block_hash = checkpoint['height'], checkpoint['hash']
+        except Exception:
+            pass        # from the genesis block
+    header, blocks = fetch_blocks(bc_host, bc_name, first, first + 1)
+    block = next(blocks, None)
+    if block is None: raise ValueError('no blocks received')
+    chain = bc.Blockchain(header['name'], hash_version=header.get('hash', bc.HASH_LEGACY))
+    block.hash_version = chain.hash_version
+    if block_hash is not None and (block.index != first or block.hash_me() != block_hash):
+        raise ValueError('block ' + str(block.index) + ' does not match the checkpoint of ' + bc_host)
+    chain._set_blocks([block], block.index)
+    chain.save(filename, app.config['BC0_LOG_FORMAT'])
+    return chain
+
+def download_chain(bc_host, bc_name, filename, host_list=()):
+    """Download the blocks missing in the local chain, resuming a previous download
+    if any: from several of the specified hosts of the chain in parallel, the
+    healthiest and fastest ones, if they have enough blocks to download, or else
+    from bc_host, checking the links of the blocks as they arrive; Return the number of blocks of the local chain."""
+    chain = bc.Blockchain.open(filename, tail=True) if os.path.isfile(filename) else start_download(bc_host, bc_name, filename)
+    height = chain.get_num_blocks()
+    hosts = [bc_host] + [h for h in host_list if h != bc_host]
+    if len(hosts) > 1:
+        heights = dict(zip(hosts, fanout_pool.map(lambda h: probe_peer(h, bc_name), hosts)))
+        last = max([n for n in heights.values() if n is not None], default=0)
+        sources = [h for h in rank_peers(hosts) if heights[h] == last][:app.config['BC0_SYNC_SOURCES']]
+        if len(sources) > 1 and last - height > app.config['BC0_SYNC_BATCH']:
+            return download_ranges(chain, sources, bc_name, last)
+        if len(sources) > 0: bc_host = sources[0]
+    _, blocks = fetch_blocks(bc_host, bc_name, height)
+    batch = []
+    for block in blocks:
+        tip = batch[-1] if len(batch) > 0 else chain.get_block(chain.get_num_blocks() - 1)
+        block.hash_version = chain.hash_version
+        if block.index != tip.index + 1 or block.previous_hash != tip.hash_me():
+            raise ValueError('block ' + str(block.index) + ' does not follow the local chain')
+        batch.append(block)
+        if len(batch) >= app.config['BC0_SYNC_BATCH']:
+            chain.append_blocks(batch)
+            chain.forget_blocks(chain.get_num_blocks() - 1)
+            batch = []
+    chain.append_blocks(batch)
+    return chain.get_num_blocks()
+
+def checkpoint_key():
+    """Get the key signing the checkpoints of the local chains: BC0_CHECKPOINT_KEY
+    or, if not given, a random key of this host, created when first needed."""
+    if app.config['BC0_CHECKPOINT_KEY'] is None:
+        filename = app_folder + '/' + adapt_to_win(hostid) + '_key'
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'w') as fout:
+                fout.write(secrets.token_hex(32))
+        except FileExistsError:
+            pass
+        with open(filename, 'r') as fin:
+            app.config['BC0_CHECKPOINT_KEY'] = fin.read().strip()
+    return app.config['BC0_CHECKPOINT_KEY']
+
+chain_locks = {}        # a lock for each local chain, serializing its writers
+chain_locks_lock = threading.Lock()
+
+def get_chain_lock(filename):
+    """Get the lock of a local chain."""
+    with chain_locks_lock:
+        return chain_locks.setdefault(filename, threading.Lock())
+
+tail_chains = {}        # for each local chain: the inode of its block log and the chain with only its last block
+
+def get_tail_chain(filename):
+    """Get a local chain with only its last block loaded, enough to append new
+    blocks, kept between calls and refreshed reading only what has been
+    appended to the block log since (under the lock of the chain)."""
+    ino = os.stat(filename).st_ino
+    ino_chain = tail_chains.get(filename)
+    if ino_chain is not None and ino_chain[0] == ino and ino_chain[1].refresh():
+        chain = ino_chain[1]
+    else:   # new, or replaced by a new block log
+        chain = bc.Blockchain.open(filename, tail=True)
+        tail_chains[filename] = (ino, chain)
+    chain.forget_blocks(chain.get_num_blocks() - 1)
+    return chain
+
+def seal_pool(pool, filename):
+    """Seal the data items of the mempool of a chain in a new block, if the
+    sealing policy says so; Return the block, or None."""
+    if not pool.is_due(app.config['BC0_SEAL_MAX_ITEMS'], app.config['BC0_SEAL_MAX_BYTES'], app.config['BC0_SEAL_MAX_AGE']):
+        return None
+    return pool.seal(get_tail_chain(filename), date.datetime.now())
+
+def pick_hosts(host_list, bc_host):
+    """Get the hosts an update is sent to: all the other hosts of a chain or,
+    in gossip mode, a random subset of them, which in turn forward the update."""
+    hosts = [h for h in host_list if h != bc_host]
+    if app.config['BC0_GOSSIP'] and len(hosts) > app.config['BC0_GOSSIP_FANOUT']:
+        hosts = random.sample(hosts, app.config['BC0_GOSSIP_FANOUT'])
+    return hosts
+
+def spread_update(bc_name, host_list, bc_host, req, data):
+    """Send an update to the hosts picked among the hosts of a chain, out of a request."""
+    for h in pick_hosts(host_list, bc_host):
+        if app.config['BC0_ASYNC_REPLICATION']: outbox.put(h, bc_name, req, data)
+        else: fanout_pool.submit(deliver, h, req, data)
+
+def replicate_block(bc_name, bc_host, filename, height):
+    """Send a new block to the other hosts of a chain, out of a request."""
+    res = get_host_list(bc_name, bc_host)
+    if res['code'] != '0': return
+    spread_update(bc_name, res['data'], bc_host, '/append_block', {'name': bc_name, 'height': height, 'chain': filename})
+
+def h_get_chain_hosts(bc_name, bc_host):
+    """Read the list of hosts of a local chain."""
+    return h_read_file(app_folder + '/' + bc_name + '_' + adapt_to_win(bc_host) + '_hosts')
+
+def h_set_chain_hosts(bc_host, data_dict):
+    """Set the hosts of a local chain or, if a membership delta is given, merge it;
+    Return the result code and the arguments of spread_update to forward the delta
+    in gossip mode if it is new, or None."""
+    bc_name = data_dict['name']
+    filename = app_folder + "/" + bc_name + "_" + adapt_to_win(bc_host) + "_hosts"
+    if 'members' not in data_dict:
+        data = {"hosts": data_dict['hosts']}
+        return h_write_file(filename, json.dumps(data)), None
+    with get_chain_lock(filename):
+        if not os.path.isfile(filename): return '-1', None   # ko: not a host of the chain
+        members = load_members(filename)
+        changed = merge_members(members, data_dict['members'])
+        if len(changed) == 0: return '0', None   # ok: already known
+        data = hosts_data(members)
+        res = h_write_file(filename, json.dumps(data))
+    if res == '0' and app.config['BC0_GOSSIP']:
+        return res, (bc_name, data['hosts'], bc_host, '/set_chain_hosts', {'name': bc_name, 'members': changed})
+    return res, None
+
+def h_upgrade_chain(bc_host, data_dict):
+    """Replace a local chain with the one sent by a peer."""
+    filename = app_folder + "/" + data_dict['name'] + "_" + adapt_to_win(bc_host) + "_chain"
+    try:
+        chain = bc.load_blockchain(data_dict['data'])
+    except:
+        return '-2'     # ko: problems in parsing the blockchain
+    with get_chain_lock(filename):
+        return h_save_chain(filename, chain)
+
+def h_get_remote_chain(filename):
+    """Get a local chain for a peer, as json."""
+    res = h_open_chain(filename)
+    if res['code'] == '0': res['data'] = res['data'].write_me(jsoned=True)
+    return json.dumps(res)
+
+def start_workers(drain_outbox=True):
+    """Start the background work of a server: migrate the old chain files, start the processes verifying
+    the chains, drain the outbox in a thread (unless the caller drains it) and seal the mempools."""
+    migrate_chain_files()
+    checkpoint_key()
+    if app.config['BC0_VERIFY_WORKERS'] > 1: bc.verify_pool(app.config['BC0_VERIFY_WORKERS'])
+    if drain_outbox: outbox.start(fanout_pool)
+    threading.Thread(target=seal_pools, name='sealer', daemon=True).start()
+
+def seal_pools():
+    """Seal the mempools whose data items have become too old (to be run in a background thread)."""
+    while True:
+        time.sleep(1.0)
+        for f in os.listdir(app_folder):
+            if not f.endswith('_chain' + bc.POOL_SUFFIX): continue
+            filename = app_folder + '/' + f[:-len(bc.POOL_SUFFIX)]
+            try:
+                with get_chain_lock(filename):
+                    if not os.path.isfile(filename): continue
+                    pool = bc.Mempool(filename)
+                    block = seal_pool(pool, filename)
+                if block is not None: replicate_block(pool.meta['name'], pool.meta['host'], filename, block.index)
+            except:
+                print('*** Unable to seal the mempool of ' + filename)
+
+def commit_data(filename, requests):
+    """Add the data of a group of concurrent requests, as (name, host, author, data),
+    to the mempool of a chain with a single durable write, sealing a block if it
+    is due and sending it to the other hosts once for the whole group;
+    Return the position of each data item, as {'block', 'item', 'pending'}."""
+    bc_name, bc_host = requests[0][:2]
+    with get_chain_lock(filename):
+        pool = bc.Mempool(filename, meta={'name': bc_name, 'host': bc_host})
+        data_items = pool.add_data_items([(r[2], r[3]) for r in requests])
+        num_data_items = pool.get_num_data_items()
+        block = seal_pool(pool, filename)
+    if block is None:
+        return [{'block': None, 'item': d.index, 'pending': num_data_items} for d in data_items]
+    replicate_block(bc_name, bc_host, filename, block.index)
+    return [{'block': block.index, 'item': d.index, 'pending': 0} for d in data_items]
+
+committer = bc.GroupCommit(commit_data, app.config['BC0_COMMIT_WINDOW'], app.config['BC0_COMMIT_MAX_BATCH'])
+
+def send_http_req_to_all_hosts(bc_name, bc_host, host_list, act_name, act_desc, data, send=deliver):
     if host_list == '':
         res = get_host_list(bc_name, bc_host)
         if res['code'] != '0': return t_bad_list(res, app_folder + '/' + bc_name + '_' + bc_host + '_hosts', bc_name)
         host_list = res['data']
         if len(host_list) == 1: return t_default(bcname=bc_name, msg="The blockchain '" + bc_name + "' has been " + act_desc + " locally.")
         ###render_template(x, userid=session['userid'], bcname=bc_name, msg="The blockchain '" + bc_name + "' has been " + act_desc + " locally.")
+    if app.config['BC0_ASYNC_REPLICATION']:
+        # Queue the requests, to be sent by the outbox in the background
+        hosts = pick_hosts(host_list, request.host)
+        for h in hosts:
+            outbox.put(h, bc_name, act_name, data)
+        return t_default(bcname=bc_name, msg="The blockchain '" + bc_name + "' has been " + act_desc + " locally and the update has been queued for " + str(len(hosts)) + " remote hosts.")
+    # Send the requests to all the hosts at the same time, waiting for them until the deadline
+    futures = {h: fanout_pool.submit(send, h, act_name, data) for h in pick_hosts(host_list, request.host)}
+    wait(futures.values(), timeout=app.config['BC0_FANOUT_DEADLINE'])
     s = ''
-    for h in host_list:
-        if h != request.host:
-            try:
-                send_http_req(h, act_name, data)
-            except:
-                s += h + ' '
+    for h, f in futures.items():
+        if not f.done() or f.exception() is not None:
+            s += h + ' '
     msg = ', but there has been problems with the hosts ' + s + ')' if len(s) > 0 else ' and in all remote hosts'
     return t_default(bcname=bc_name, msg="The blockchain '" + bc_name + "' has been " + act_desc + " locally" + msg + ".")
     ###render_template(x, userid=session['userid'], bcname=bc_name, msg="The blockchain '" + bc_name + "' has been " + act_desc + " locally" + msg + ".")
 
 
+outbox = bc0outbox.Outbox(app_folder + '/' + adapt_to_win(hostid) + '_outbox', deliver_ops)
+
+
 # Helper (web remote) functions **********************************
 @app.route('/get_chain_hosts', methods=['GET'])
 def get_chain_hosts():
     """Get the list of hosts of the specified blockchain from the specified host."""
     bc_name = request.args.get('name')
-    bc_host = request.host
-    filename = app_folder + '/' + bc_name + '_' + adapt_to_win(bc_host) + '_hosts'
-    res = h_read_file(filename)
+    filename = app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_hosts'
+    res = h_get_chain_hosts(bc_name, request.host)
     if res['code'] != '0': return t_bad_file(res, filename, bc_name)
     return res['data']
 
 
 @app.route('/set_chain_hosts', methods=['POST'])
 def set_chain_hosts():
-    data_dict = json.loads(request.data)
-    bc_name = data_dict['name']
-    host_list = data_dict['hosts']
-    filename = app_folder + "/" + bc_name + "_" + adapt_to_win(request.host) + "_hosts"
-    data = {"hosts": host_list}
-    return h_write_file(filename, json.dumps(data))
+    """Set the hosts of the local chain or, if a membership delta is given,
+    merge it, forwarding it in gossip mode if it is new."""
+    res, update = h_set_chain_hosts(request.host, json.loads(request.data))
+    if update is not None: spread_update(*update)
+    return res
 
 
 @app.route('/upgrade_chain', methods=['POST'])
 def upgrade_chain():
-    data_dict = json.loads(request.data)
+    return h_upgrade_chain(request.host, json.loads(request.data))
+
+
+@app.route('/append_block', methods=['POST'])
+def append_block():
+    """Append new blocks (jsoned, or in the binary format) to the local chain, if they follow its last block."""
+    if request.mimetype == BIN_MIMETYPE:
+        blocks = bc.read_blocks([request.data])
+        data_dict = next(blocks)
+    else:
+        data_dict = json.loads(request.data)
+        blocks = (bc.load_block(desc) for desc in data_dict['blocks'])
     bc_name = data_dict['name']
-    data = data_dict['data']
+    height = data_dict['height']
     filename = app_folder + "/" + bc_name + "_" + adapt_to_win(request.host) + "_chain"
-    return h_write_file(filename, data)
+    with get_chain_lock(filename):
+        res = h_open_chain(filename)
+        if res['code'] != '0': return json.dumps({'code': res['code']})
+        res = h_append_blocks(res['data'], height, data_dict['parent'], blocks)
+    if res.get('added', 0) > 0 and app.config['BC0_GOSSIP']:     # forward only the blocks not seen before
+        replicate_block(bc_name, request.host, filename, height)
+    return json.dumps(res)
+
+
+@app.route('/outbox', methods=['GET'])
+def get_outbox():
+    """Get the queue depth and the lag of the updates waiting for each peer."""
+    return json.dumps(outbox.stats())
+
+
+@app.route('/get_blocks', methods=['GET'])
+def get_blocks():
+    """Stream the blocks of the local chain in a range of heights, as a header
+    line followed by a record for each block (a json line, or the binary format
+    if the client accepts it), compressed if the client accepts it."""
+    bc_name = request.args.get('name')
+    try:
+        first = read_int(request.args, 'from', 0)
+        last = read_int(request.args, 'to')
+    except ValueError:
+        return json.dumps({'code': '-2'}), 400      # ko: an argument is not an integer
+    filename = app_folder + "/" + bc_name + "_" + adapt_to_win(request.host) + "_chain"
+    if not os.path.isfile(filename): return json.dumps({'code': '-1'}), 404
+    fmt = bc.FORMAT_BIN if BIN_MIMETYPE in request.headers.get('Accept', '') else bc.FORMAT_JSON
+    chunks = bc.stream_blocks(filename, first, last, fmt=fmt)
+    headers = {}
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks, mimetype=BIN_MIMETYPE if fmt == bc.FORMAT_BIN else 'application/x-ndjson', headers=headers)
+
+def gzip_chunks(chunks):
+    """Compress a stream of chunks in the gzip format."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if len(data) > 0: yield data
+    yield compressor.flush()
+
+
+@app.route('/chain_content', methods=['GET'])
+def chain_content():
+    """Get a page of the blocks of the local chain, as json: 'from' and 'to'
+    select a range of heights, 'page' and 'size' a page of that range, and
+    'order' is 'newest' (the default) or 'oldest' first; an unchanged page
+    is not sent again to a client giving its entity tag."""
+    bc_name = request.args.get('name')
+    try:
+        page = max(0, read_int(request.args, 'page', 0))
+        size = min(max(1, read_int(request.args, 'size', app.config['BC0_PAGE_SIZE'])), 10 * app.config['BC0_PAGE_SIZE'])
+        first = read_int(request.args, 'from')
+        last = read_int(request.args, 'to')
+    except ValueError:
+        return json.dumps({'code': '-2'}), 400      # ko: an argument is not an integer
+    newest_first = request.args.get('order', 'newest') != 'oldest'
+    filename = app_folder + "/" + bc_name + "_" + adapt_to_win(request.host) + "_chain"
+    if not os.path.isfile(filename): return json.dumps({'code': '-1'}), 404
+    etag = chain_etag(filename, page, size, first, last, newest_first)
+    if request.if_none_match.contains(etag):
+        res = Response(status=304)
+    else:
+        res = h_open_chain(filename)
+        if res['code'] != '0': return json.dumps({'code': res['code']})
+        res = Response(json.dumps({'code': '0', 'data': chain_page(res['data'], page, size, first, last, newest_first)}),
+                       mimetype='application/json')
+    res.set_etag(etag)
+    res.headers['Cache-Control'] = 'no-cache'
+    return res
+
+
+@app.route('/get_proof', methods=['GET'])
+def get_proof():
+    """Get the proof that a data item is included in the local chain: the item,
+    its merkle path and the headers of the blocks from its own up to the
+    height 'to' (just its own by default), to be checked with bc.check_proof
+    and by linking each header to the hash of the previous one."""
+    bc_name = request.args.get('name')
+    try:
+        num = read_int(request.args, 'block', -1)
+        item = read_int(request.args, 'item', -1)
+        last = read_int(request.args, 'to', num)
+    except ValueError:
+        return json.dumps({'code': '-2'}), 400      # ko: an argument is not an integer
+    filename = app_folder + "/" + bc_name + "_" + adapt_to_win(request.host) + "_chain"
+    res = h_open_chain(filename)
+    if res['code'] != '0': return json.dumps({'code': res['code']})
+    chain = res['data']
+    if chain.hash_version != bc.HASH_MERKLE:
+        return json.dumps({'code': '-3'})       # ko: the blocks of the chain do not commit to merkle roots
+    block = chain.get_block(num)
+    if block is None or block.get_data_item(item) is None:
+        return json.dumps({'code': '-1'})       # ko: no such block or data item
+    last = min(last, chain.get_num_blocks() - 1)
+    headers = [chain.get_block(i).get_header() for i in range(num, max(num, last) + 1)]
+    return json.dumps({'code': '0', 'data': {'item': block.get_data_item(item).dump_me(),
+                                             'path': block.get_proof(item), 'headers': headers}})
+
+
+@app.route('/query', methods=['GET'])
+def query():
+    """Get a page of the data items of the local chain by an author and/or in the
+    blocks with timestamps in a range [since, until), as found in the query index of the chain."""
+    bc_name = request.args.get('name')
+    author = request.args.get('author')
+    since = request.args.get('since')
+    until = request.args.get('until')
+    try:
+        page = max(0, read_int(request.args, 'page', 0))
+        size = min(max(1, read_int(request.args, 'size', bc.QUERY_PAGE_SIZE)), 10 * bc.QUERY_PAGE_SIZE)
+    except ValueError:
+        return json.dumps({'code': '-2'}), 400      # ko: an argument is not an integer
+    filename = app_folder + "/" + bc_name + "_" + adapt_to_win(request.host) + "_chain"
+    res = h_open_index(filename)
+    if res['code'] != '0': return json.dumps({'code': res['code']})
+    total, found = res['data'].find(author, since, until, page * size, size)
+    res = h_open_chain(filename)
+    if res['code'] != '0': return json.dumps({'code': res['code']})
+    items = [{'block': b, 'item': i, 'data': res['data'].get_block(b).get_data_item(i).dump_me()} for b, i in found]
+    return json.dumps({'code': '0', 'data': {'total': total, 'page': page, 'size': size, 'items': items}})
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Get the metrics of this host in the Prometheus text format."""
+    for stat, value in cache.stats().items():
+        CACHE_STATS.set(value, stat=stat)
+    for stat, value in committer.stats().items():
+        COMMIT_STATS.set(value, stat=stat)
+    OUTBOX_DEPTH.clear()
+    OUTBOX_LAG.clear()
+    for peer, stats in outbox.stats().items():
+        OUTBOX_DEPTH.set(stats['depth'], peer=peer)
+        OUTBOX_LAG.set(stats['lag'], peer=peer)
+    with peer_health_lock:
+        health = {peer: dict(h) for peer, h in peer_health.items()}
+    for peer, h in health.items():
+        if h['rtt'] is not None: PEER_RTT.set(h['rtt'], peer=peer)
+        PEER_FAILURES.set(h['failures'], peer=peer)
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/cache', methods=['GET'])
+def get_cache():
+    """Get the hit/miss counters of the cache of the loaded chains and host lists."""
+    return json.dumps(cache.stats())
+
+
+@app.route('/get_checkpoint', methods=['GET'])
+def get_checkpoint():
+    """Get the height and the hash of the last verified block of the local chain."""
+    bc_name = request.args.get('name')
+    filename = app_folder + "/" + bc_name + "_" + adapt_to_win(request.host) + "_chain"
+    checkpoint = bc.read_checkpoint(filename, checkpoint_key()) if os.path.isfile(filename) else None
+    if checkpoint is None: return json.dumps({'code': '-1'})     # ko: not verified
+    return json.dumps({'code': '0', 'height': checkpoint[0], 'hash': checkpoint[1]})
 
 
 @app.route('/get_remote_chain', methods=['GET'])
 def get_remote_chain():
-    filename = request.args.get('filename')
-    return h_read_file(filename, jsoned=True)
+    return h_get_remote_chain(request.args.get('filename'))
 
 
 @app.route('/delete_remote_chain', methods=['POST'])
@@ -203,9 +975,13 @@ def delete_remote_chain():
     bc_name = data_dict['name']
     filename1 = app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_hosts'
     filename2 = app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_chain'
+    if app.config['BC0_GOSSIP']:
+        res = get_host_list(bc_name, request.host)
+        if res['code'] != '0': return "0"     # ok: already deleted, not to be forwarded again
     res1 = h_delete_file(filename1)
-    res2 = h_delete_file(filename2)
+    res2 = h_delete_chain(filename2)
     if res1 != "0" or res2 != "0": return "-1"
+    if app.config['BC0_GOSSIP']: spread_update(bc_name, res['data'], request.host, '/delete_remote_chain', {'name': bc_name})
     return "0"
 
 
@@ -255,9 +1031,9 @@ def create_chain():
     if os.path.isfile(filename1): return t_default(bcname=bc_name, msg="A blockchain named '" + bc_name + "' already exists.")
     # Create the two required local files
     chain = bc.Blockchain(name=bc_name, author=session['userid'])
-    hosts_data = {"hosts": [request.host]}
-    res1 = h_write_file(filename1, json.dumps(hosts_data))
-    res2 = h_write_file(filename2, chain.write_me(jsoned=True))
+    res1 = h_write_file(filename1, json.dumps(hosts_data({request.host: [1, True]})))
+    with get_chain_lock(filename2):
+        res2 = h_save_chain(filename2, chain)
     if res1 != "0" or res2 != "0": return t_default(bcname=bc_name, msg="Problems in creating the blockchain file '" + filename1 + "'.")
     return t_default(bcname=bc_name, msg="The blockchain '" + bc_name + "' has been created.")
 
@@ -274,7 +1050,7 @@ def delete_chain():     # ***bisogna cancellare la bc da tutti gli host
     filename1 = app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_hosts'
     filename2 = app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_chain'
     res1 = h_delete_file(filename1)
-    res2 = h_delete_file(filename2)
+    res2 = h_delete_chain(filename2)
     if res1 != "0" or res2 != "0": return t_default(bcname=bc_name, msg="Problems in deleting the blockchain '" + bc_name + "'.")
     # Upgrade hosts
     return send_http_req_to_all_hosts(bc_name, request.host, host_list, '/delete_remote_chain', 'deleted', {'name': bc_name})
@@ -296,9 +1072,14 @@ def show_content():
     bc_name = read_form()
     # Read the chain and show its content
     filename = app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_chain'
-    res = h_read_file(filename)
+    res = h_open_chain(filename)
     if res['code'] != '0': return t_bad_file(res, filename, bc_name)
-    return t_default(bcname=bc_name, msg=res['data'])
+    try:
+        page = max(0, read_int(request.form, 'page', 0))
+    except ValueError:
+        return t_default(bcname=bc_name, msg='Please specify the number of a page of the blockchain.')
+    content = chain_page(res['data'], page)
+    return render_template(x, hostid=hostid, userid=session['userid'], bcname=bc_name, msg=json.dumps(content), page=page, pages=content['pages'])
 
 
 @app.route('/check_chain', methods=['POST'])
@@ -307,10 +1088,11 @@ def check_chain():
     bc_name = read_form()
     # Read the chain and check it
     filename = app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_chain'
-    res = h_read_file(filename)
-    if res['code'] != '0': return t_bad_file(res, filename, bc_name)
-    chain = bc.load_blockchain(res['data'])
-    check = chain.check_me()
+    if not os.path.isfile(filename): return t_bad_file({'code': '-1'}, filename, bc_name)
+    try:
+        check = bc.verify_chain(filename, workers=app.config['BC0_VERIFY_WORKERS'], chunk_size=app.config['BC0_VERIFY_CHUNK_SIZE'], key=checkpoint_key())
+    except:
+        return t_bad_file({'code': '-2'}, filename, bc_name)
     if check == -1: return t_default(bcname=bc_name, msg="The blockchain '" + bc_name + "' is ok!")
     return t_default(bcname=bc_name, msg="The blockchain '" + bc_name + "' is in a wrong state from block " + str(check) + "!")
 
@@ -335,26 +1117,24 @@ def enter_chain():
         for h in host_list:
             if h == request.host:
                 return t_default(bcname=bc_name, bchost=bc_host, msg='This address is already in the list of the blockchain hosts.')
+        members = parsed_data.get('members', {h: [0, True] for h in host_list})
     except:
         return t_default(bcname=bc_name, bchost=bc_host, msg='Unable to parse the data about the hosts of the blockchain.')
-    host_list.append(request.host)
-    data = {"hosts": host_list}
+    delta = {request.host: [members.get(request.host, [0])[0] + 1, True]}
+    merge_members(members, delta)
+    data = hosts_data(members)
+    host_list = data['hosts']
     res = h_write_file(app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_hosts', json.dumps(data))
     if res != '0': return t_default(bcname=bc_name, bchost=bc_host, msg="Problems in upgrading the blockchain '" + bc_name + "'.")
-    # Get the chain data from the specified remote host
+    # Get the chain data from the specified remote host (only the missing blocks, if the download is resumed)
+    filename = app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_chain'
     try:
-        res = requests.get('http://' + bc_host + '/get_remote_chain?filename=' + bc_name + '_' + adapt_to_win(bc_host) + '_chain', timeout=0.1)
-        res.raise_for_status()
-        data = res.text.replace("'", "\"")  # json requires property names delimited by double quotes...
-        parsed_data = json.loads(data)
-        if parsed_data['code'] != '0':
-            return t_default(bcname=bc_name, bchost=bc_host, msg='The download of the blockchain data has not been completed.')
-        else:
-            h_write_file(app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_chain', parsed_data['data'])
+        with get_chain_lock(filename):
+            download_chain(bc_host, bc_name, filename, [h for h in host_list if h != request.host])
     except:
-        return t_default(bcname=bc_name, bchost=bc_host, msg='The download of the blockchain data has not been completed.')
+        return t_default(bcname=bc_name, bchost=bc_host, msg='The download of the blockchain data has not been completed: please enter the blockchain again to resume it.')
     # Upgrade hosts
-    return send_http_req_to_all_hosts(bc_name, request.host, host_list, '/set_chain_hosts', 'upgraded', {'name': bc_name, 'hosts': host_list})
+    return send_http_req_to_all_hosts(bc_name, request.host, host_list, '/set_chain_hosts', 'upgraded', {'name': bc_name, 'hosts': host_list, 'members': delta})
 
 
 @app.route('/leave_chain', methods=['POST'])
@@ -365,15 +1145,20 @@ def leave_chain():
     res = get_host_list(bc_name, request.host)
     if res['code'] != '0': return t_bad_list(res, app_folder + '/' + bc_name + '_' + request.host + '_hosts', bc_name)
     host_list = res['data']
+    try:
+        members = load_members(app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_hosts')
+    except:
+        members = {}
+    delta = {request.host: [members.get(request.host, [0])[0] + 1, False]}
     # Upgrade data locally
     for h in host_list:
         if h == request.host: host_list.remove(h)
     res1 = h_delete_file(app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_hosts')
-    res2 = h_delete_file(app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_chain')
+    res2 = h_delete_chain(app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_chain')
     if res1 != "0" or res2 != "0": return t_default(bcname=bc_name, msg="Problems in leaving the blockchain '" + bc_name + "'.")
     if len(host_list) == 0: return t_default(bcname=bc_name, msg="The blockchain '" + bc_name + "' has been left locally and deleted.")
     # Upgrade hosts
-    return send_http_req_to_all_hosts(bc_name, request.host, host_list, '/set_chain_hosts', 'upgraded', {'name': bc_name, 'hosts': host_list})
+    return send_http_req_to_all_hosts(bc_name, request.host, host_list, '/set_chain_hosts', 'upgraded', {'name': bc_name, 'hosts': host_list, 'members': delta})
 
 
 @app.route('/add_data', methods=['POST'])
@@ -385,17 +1170,17 @@ def add_data():
     bc_data = bc_data.replace("'", " ").replace('"', ' ')
     # Read the local chain
     filename = app_folder + '/' + bc_name + '_' + adapt_to_win(request.host) + '_chain'
-    res = h_read_file(filename)
-    if res['code'] != '0': return t_bad_file(res, filename, bc_name)
-    chain = bc.load_blockchain(res['data'])
-    # Add data locally
-    chain.add_data(session['userid'], bc_data)
-    chain.add_block(date.datetime.now())
-    data = chain.write_me(jsoned=True)
-    res = h_write_file(filename, data)
-    if res != "0": return t_default(bcname=bc_name, msg="Problems in updating the blockchain file '" + filename + "'.")
-    # Upgrade hosts
-    return send_http_req_to_all_hosts(bc_name, request.host, '', '/upgrade_chain', 'upgraded', {'name': bc_name, 'data': data})
+    if not os.path.isfile(filename): return t_bad_file({'code': '-1'}, filename, bc_name)
+    # Add data to the mempool of the chain together with the concurrent requests, sealing a block if it is due
+    # (and sending only the new block to the other hosts)
+    try:
+        res = committer.submit(filename, (bc_name, request.host, session['userid'], bc_data))
+    except:
+        return t_default(bcname=bc_name, msg="Problems in updating the blockchain file '" + filename + "'.")
+    if res['block'] is None: return t_default(bcname=bc_name, msg="The data has been added to the blockchain '" + bc_name + "' as item " + str(res['item']) + ", waiting to be sealed in a block with " + str(res['pending'] - 1) + " other data items.")
+    return t_default(bcname=bc_name, msg="The data has been added to the blockchain '" + bc_name + "' as item " + str(res['item']) + " of block " + str(res['block']) + ", which has been sent to the other hosts.")
 
 
-app.run(port=myport, host=myhost)
+if __name__ == '__main__':     # not when imported by the processes verifying a chain
+    start_workers()
+    app.run(port=myport, host=myhost)
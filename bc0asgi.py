@@ -0,0 +1,308 @@
+"""
+This file is part of BC0, Copyright 2018, Luca Mari.
+
+BC0 is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 2.
+
+BC0 is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License <http://www.gnu.org/licenses/> for more details.
+"""
+
+# Asynchronous server: the peer endpoints are served by coroutines on an event loop,
+# so that slow peers only keep connections open, and the rest by the flask app in threads
+import asyncio
+import io
+import json
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+try:
+    import httpx
+    import uvicorn
+except ImportError:     # optional: only needed in the asynchronous mode
+    httpx = uvicorn = None
+
+import bc0
+import bc0lib as bc
+
+BACKLOG = 4096          # connections waiting to be accepted
+
+config = bc0.app.config
+io_pool = ThreadPoolExecutor(max_workers=config['BC0_IO_WORKERS'], thread_name_prefix='io')
+ui_pool = ThreadPoolExecutor(max_workers=config['BC0_UI_WORKERS'], thread_name_prefix='ui')
+peer_client = None      # the keep-alive connections to the peers, open while the server runs
+background = set()      # the updates being sent to the peers
+
+
+async def run_io(function, *args):
+    """Run a blocking function (reading or writing files) in a thread, out of the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(io_pool, function, *args)
+
+
+def get_peer_client():
+    """Get the client of the connections to the peers, creating it if missing."""
+    global peer_client
+    if peer_client is None:
+        peer_client = httpx.AsyncClient(timeout=config['BC0_PEER_TIMEOUT'],
+                                        limits=httpx.Limits(max_connections=config['BC0_PEER_CONNECTIONS'],
+                                                            max_keepalive_connections=config['BC0_PEER_CONNECTIONS']))
+    return peer_client
+
+
+async def send_http_req(host, req, data, content_type='application/json'):
+    """Send a request with json (or already encoded) data to a peer, without blocking the event loop;
+    Return the text of the response."""
+    if content_type == 'application/json': data = json.dumps(data)
+    start = time.perf_counter()
+    try:
+        res = await get_peer_client().post('http://' + host + req, content=data, headers={'content-type': content_type})
+        res.raise_for_status()
+    except Exception:
+        bc0.PEER_ERRORS.inc(peer=host, req=req)
+        raise
+    finally:
+        bc0.PEER_SECONDS.observe(time.perf_counter() - start, peer=host, req=req)
+    return res.text
+
+
+async def post_blocks(host, req, chain, height):
+    """Send the blocks of a chain from the specified height to a peer, as bc0.post_blocks does."""
+    if config['BC0_WIRE_FORMAT'] == bc.FORMAT_BIN:
+        try:
+            return await send_http_req(host, req, await run_io(bc0.blocks_to_pack, chain, height), bc0.BIN_MIMETYPE)
+        except httpx.HTTPStatusError:
+            pass    # the peer does not understand the binary format
+    return await send_http_req(host, req, await run_io(bc0.blocks_to_send, chain, height))
+
+
+async def send_blocks(host, req, data):
+    """Send the blocks of a chain from the height in the data to a peer, as bc0.send_blocks does;
+    the chain is read from its file."""
+    res = await run_io(bc0.h_open_chain, data['chain'])
+    if res['code'] != '0': return      # the chain has been deleted locally in the meantime
+    chain = res['data']
+    if data['height'] >= chain.get_num_blocks(): return
+    res = json.loads(await post_blocks(host, req, chain, data['height']))
+    if res['code'] == '-3' and chain.base < res['from'] < data['height']:     # ko: the peer misses some blocks
+        res = json.loads(await post_blocks(host, req, chain, res['from']))
+    if res['code'] != '0':
+        await send_http_req(host, '/upgrade_chain', {'name': chain.name, 'data': await run_io(chain.write_me, True)})
+
+
+async def deliver(host, req, data):
+    """Send an update request to a peer, raising on failure."""
+    if req == '/append_block': return await send_blocks(host, req, data)
+    return await send_http_req(host, req, data)
+
+
+async def deliver_ops(host, bc_name, ops):
+    """Send the updates queued in the outbox for a peer and a chain, as bc0.deliver_ops does."""
+    for req, data in ops:
+        await deliver(host, req, data)
+
+
+async def deliver_quietly(host, req, data):
+    """Send an update request to a peer, out of a request."""
+    try:
+        await deliver(host, req, data)
+    except Exception as e:
+        print('*** Unable to send ' + req + ' to ' + host + ': ' + type(e).__name__)
+
+
+def run_in_background(coroutine):
+    """Run a coroutine in a task that is kept until it is done."""
+    task = asyncio.ensure_future(coroutine)
+    background.add(task)
+    task.add_done_callback(background.discard)
+    return task
+
+
+async def spread_update(bc_name, host_list, bc_host, req, data):
+    """Send an update to the hosts picked among the hosts of a chain, as bc0.spread_update does, out of a request."""
+    hosts = bc0.pick_hosts(host_list, bc_host)
+    if config['BC0_ASYNC_REPLICATION']:     # the outbox is drained on the event loop
+        await run_io(lambda: [bc0.outbox.put(h, bc_name, req, data) for h in hosts])
+        return
+    for h in hosts:
+        run_in_background(deliver_quietly(h, req, data))
+
+
+def read_json(body, *keys):
+    """Get the json object in the body of a request, or None if malformed or missing any of the specified keys."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or any(k not in data for k in keys): return None
+    return data
+
+
+# The peer endpoints: each one gets the host, the query arguments and the body of the request,
+# and returns the status and the text of the response
+async def get_chain_hosts(host, args, body):
+    res = await run_io(bc0.h_get_chain_hosts, args.get('name'), host)
+    if res['code'] != '0': return 404, json.dumps(res)
+    return 200, res['data']
+
+
+async def set_chain_hosts(host, args, body):
+    data = read_json(body, 'name')
+    if data is None or ('hosts' not in data and 'members' not in data): return 200, '-2'    # ko: malformed request
+    res, update = await run_io(bc0.h_set_chain_hosts, host, data)
+    if update is not None: await spread_update(*update)
+    return 200, res
+
+
+async def upgrade_chain(host, args, body):
+    data = read_json(body, 'name', 'data')
+    if data is None: return 200, '-2'    # ko: malformed request
+    return 200, await run_io(bc0.h_upgrade_chain, host, data)
+
+
+async def get_remote_chain(host, args, body):
+    return 200, await run_io(bc0.h_get_remote_chain, args.get('filename'))
+
+
+PEER_ROUTES = {
+    ('GET', '/get_chain_hosts'): get_chain_hosts,
+    ('POST', '/set_chain_hosts'): set_chain_hosts,
+    ('POST', '/upgrade_chain'): upgrade_chain,
+    ('GET', '/get_remote_chain'): get_remote_chain,
+}
+
+
+async def read_body(receive):
+    """Read the whole body of a request."""
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+def wsgi_environ(scope, body):
+    """Get the WSGI environment of a request."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'): key = 'HTTP_' + key
+        value = value.decode('latin-1')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+class AsgiApp:
+    """Serve the peer endpoints with coroutines, and any other request with a
+    WSGI app (the flask app) run in a thread pool, chunk by chunk for the
+    streamed responses."""
+
+    def __init__(self, wsgi_app, routes=PEER_ROUTES):
+        self.wsgi_app = wsgi_app
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        body = await read_body(receive)
+        handler = self.routes.get((scope['method'], scope['path']))
+        if handler is None:
+            await self.serve_wsgi(scope, body, send)
+            return
+        start = time.perf_counter()
+        headers = dict((name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers'])
+        server = scope.get('server') or ('localhost', 80)
+        host = headers.get('host', server[0] + ':' + str(server[1]))
+        args = {k: v[0] for k, v in parse_qs(scope['query_string'].decode('latin-1')).items()}
+        try:
+            status, text = await handler(host, args, body)
+        except Exception:
+            traceback.print_exc()
+            status, text = 500, 'Internal Server Error'
+        data = text.encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/html; charset=utf-8'), (b'content-length', str(len(data)).encode('latin-1'))]})
+        await send({'type': 'http.response.body', 'body': data})
+        bc0.REQUEST_SECONDS.observe(time.perf_counter() - start, route=scope['path'], method=scope['method'], status=status)
+
+    async def serve_wsgi(self, scope, body, send):
+        """Serve a request with the WSGI app."""
+        loop = asyncio.get_running_loop()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+            return lambda data: None    # the write callable is not supported
+
+        chunks = await loop.run_in_executor(ui_pool, lambda: iter(self.wsgi_app(wsgi_environ(scope, body), start_response)))
+        try:
+            started = False
+            while True:
+                chunk = await loop.run_in_executor(ui_pool, next, chunks, None)
+                if not started:     # the response starts at the first chunk, when the headers are sure to be set
+                    await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+                    started = True
+                if chunk is None:
+                    break
+                if len(chunk) > 0:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(chunks, 'close'): await loop.run_in_executor(ui_pool, chunks.close)
+
+    async def lifespan(self, receive, send):
+        """Start the background work of the server, draining the outbox on the event loop,
+    and close the connections to the peers when it stops."""
+        global peer_client
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await run_io(bc0.start_workers, False)
+                get_peer_client()
+                run_in_background(bc0.outbox.run_async(deliver_ops))
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for task in list(background): task.cancel()
+                if peer_client is not None:
+                    await peer_client.aclose()
+                    peer_client = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = AsgiApp(bc0.app)
+
+
+if __name__ == '__main__':
+    if uvicorn is None:
+        print('*** The asynchronous mode needs the modules httpx and uvicorn (pip install httpx uvicorn)')
+        sys.exit(1)
+    uvicorn.run(app, host=bc0.myhost, port=bc0.myport, backlog=BACKLOG, lifespan='on')
@@ -0,0 +1,315 @@
+"""
+This file is part of BC0, Copyright 2018, Luca Mari.
+
+BC0 is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 2.
+
+BC0 is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License <http://www.gnu.org/licenses/> for more details.
+"""
+
+# Benchmarks of the hot paths of bc0lib and of a network of local bc0 peers
+import argparse
+import datetime as date
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import bc0lib as bc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(samples, p):
+    """Get the p-th percentile of a list of samples (nearest rank)."""
+    if len(samples) == 0:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(name, samples, ops, peak=None, **extra):
+    """Get the results of a benchmark from its latencies in seconds and the
+    number of operations done in each sample."""
+    total = sum(samples)
+    res = {
+        "name": name,
+        "samples": len(samples),
+        "ops_per_sec": round(ops * len(samples) / total, 2) if total > 0 else None,
+        "p50_ms": round(percentile(samples, 50) * 1000, 3) if samples else None,
+        "p99_ms": round(percentile(samples, 99) * 1000, 3) if samples else None,
+        "peak_bytes": peak
+    }
+    res.update(extra)
+    return res
+
+
+def synthetic_chain(num_blocks, num_items, payload, hash_version=bc.HASH_MERKLE):
+    """Get a blockchain with the specified number of blocks, each with the
+    specified number of data items of the specified size."""
+    chain = bc.Blockchain('bench', 'bench', 'genesis block', hash_version)
+    start = date.datetime(2020, 1, 1)
+    for i in range(1, num_blocks):
+        for j in range(num_items):
+            chain.add_data('author' + str(j % 10), {'n': i * num_items + j, 'p': 'x' * payload})
+        chain.add_block(start + date.timedelta(seconds=i))
+    return chain
+
+
+def run_micro(args):
+    """Run the micro benchmarks over a synthetic chain in a temporary folder."""
+    results = []
+    folder = tempfile.mkdtemp(prefix='bc0bench_')
+    try:
+        chain = synthetic_chain(args.blocks, args.items, args.payload)
+        path = os.path.join(folder, 'bench_chain')
+        chain.save(path, args.format)
+        legacy = chain.write_me(jsoned=True)
+        n = chain.get_num_blocks()
+
+        def reset_hashes():
+            for i in range(n):
+                chain.get_block(i).reset_hash()
+
+        def hash_all():
+            for i in range(n):
+                chain.get_block(i).hash_me()
+
+        def add_data_round_trip():
+            pool = bc.Mempool(path, meta={'name': 'bench'})
+            for j in range(args.items):
+                pool.add_data('author' + str(j % 10), {'p': 'x' * args.payload})
+            opened = bc.Blockchain.open(path, tail=True)
+            pool.seal(opened, date.datetime.now())
+
+        cases = [       # name, function, operations, setup before each run (not timed)
+            ("hash_me", hash_all, n, reset_hashes),
+            ("check_me", chain.check_me, n, reset_hashes),
+            ("write_me", lambda: chain.write_me(jsoned=True), n, None),
+            ("pack_me", chain.pack_me, n, None),
+            ("load_blockchain", lambda: bc.load_blockchain(legacy), n, None),
+            ("open", lambda: bc.Blockchain.open(path), n, None),
+            ("open_tail", lambda: bc.Blockchain.open(path, tail=True), 1, None),
+            ("iter_blocks", lambda: sum(1 for _ in bc.iter_blocks(path)), n, None),
+            ("verify_chain", lambda: bc.verify_chain(path, args.workers), n, None),
+            ("add_data_round_trip", add_data_round_trip, args.items, None),
+        ]
+        for name, fun, ops, setup in cases:
+            if args.only and name not in args.only:
+                continue
+            samples = []
+            for _ in range(args.repeat):
+                if setup is not None: setup()
+                t0 = time.perf_counter()
+                fun()
+                samples.append(time.perf_counter() - t0)
+            if setup is not None: setup()
+            tracemalloc.start()     # a separate run, not to slow down the timed ones
+            fun()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append(summarize(name, samples, ops, peak, blocks=n, items=args.items, payload=args.payload))
+            if not args.quiet:
+                print(json.dumps(results[-1]), file=sys.stderr)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+class Peer:
+    """Handle a local bc0 server, started as a separate process."""
+
+    def __init__(self, folder, port):
+        """Class constructor: start the server on the specified port, in the specified folder."""
+        self.host = '127.0.0.1:' + str(port)
+        self.log = open(os.path.join(folder, 'peer_' + str(port) + '.log'), 'w')
+        self.process = subprocess.Popen([sys.executable, os.path.join(HERE, 'bc0.py'), str(port), '127.0.0.1'],
+                                        cwd=folder, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout=15.0):
+        """Wait for the server to accept connections."""
+        import requests
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                requests.get('http://' + self.host + '/outbox', timeout=0.5)
+                return
+            except requests.RequestException:
+                time.sleep(0.1)
+        raise RuntimeError('the peer ' + self.host + ' has not started')
+
+    def peak_memory(self):
+        """Get the peak resident memory of the server in bytes, where available."""
+        try:
+            with open('/proc/' + str(self.process.pid) + '/status') as fin:
+                for line in fin:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        """Stop the server."""
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+def seed_chain(folder, host, num_blocks, payload, fmt):
+    """Create the chain 'bench' of a peer (before starting it) with the specified
+    number of blocks, each with one data item of the specified size; Return the number of blocks."""
+    from bc0cli import import_records
+    prefix = os.path.join(folder, 'bench_' + host.replace(':', '_'))
+    with open(prefix + '_hosts', 'w') as fout:
+        fout.write(json.dumps({'hosts': [host], 'members': {host: [1, True]}}))
+    records = (('owner', 'x' * payload, payload) for _ in range(num_blocks - 1))
+    import_records(prefix + '_chain', records, 'bench', 'owner', block_items=1, fmt=fmt)
+    return chain_blocks(prefix + '_chain')
+
+
+def chain_blocks(path):
+    """Get the number of blocks in the block log at the specified path, or 0 if missing."""
+    if not os.path.isfile(path):
+        return 0
+    header, offsets, _ = bc.log_extent(path)
+    return header.get("base", 0) + len(offsets)
+
+
+def run_e2e(args):
+    """Run the end-to-end benchmark: start some local peers, the first one with
+    a chain of the specified number of blocks, make the others enter the chain,
+    then add data to them from concurrent clients."""
+    import requests
+    folder = tempfile.mkdtemp(prefix='bc0bench_')
+    shutil.copy(os.path.join(HERE, 'bc0.html'), folder)
+    num_blocks = seed_chain(folder, '127.0.0.1:' + str(args.port), args.blocks, args.payload, args.format)
+    peers = [Peer(folder, args.port + k) for k in range(args.peers)]
+    results = []
+    try:
+        for peer in peers:
+            peer.wait_ready()
+
+        def client(peer, userid):
+            session = requests.Session()
+            session.post('http://' + peer.host + '/login', data={'userid': userid}, timeout=args.timeout)
+            return session
+
+        samples = []
+        joined = []     # the blocks each joining peer has got
+        for peer in peers[1:]:
+            session = client(peer, 'joiner')
+            t0 = time.perf_counter()
+            session.post('http://' + peer.host + '/enter_chain', data={'name': 'bench', 'host': peers[0].host}, timeout=args.timeout)
+            samples.append(time.perf_counter() - t0)
+            joined.append(chain_blocks(os.path.join(folder, 'bench_' + peer.host.replace(':', '_') + '_chain')))
+        if samples:
+            results.append(summarize("enter_chain", samples, 1, peers=args.peers, blocks=num_blocks, joined_blocks=min(joined)))
+
+        lock = threading.Lock()
+        latencies = []
+        errors = [0]
+
+        def worker(c):
+            peer = peers[c % len(peers)]
+            session = client(peer, 'user' + str(c))
+            for r in range(args.requests):
+                t0 = time.perf_counter()
+                try:
+                    res = session.post('http://' + peer.host + '/add_data',
+                                       data={'name': 'bench', 'data': 'x' * args.payload}, timeout=args.timeout)
+                    ok = res.status_code == 200
+                except requests.RequestException:
+                    ok = False
+                with lock:
+                    latencies.append(time.perf_counter() - t0)
+                    if not ok: errors[0] += 1
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            list(pool.map(worker, range(args.clients)))
+        elapsed = time.perf_counter() - t0
+        res = summarize("add_data", latencies, 1, max(filter(None, [p.peak_memory() for p in peers]), default=None),
+                        peers=args.peers, clients=args.clients, errors=errors[0])
+        res["ops_per_sec"] = round(len(latencies) / elapsed, 2) if elapsed > 0 else None    # with concurrent clients
+        results.append(res)
+        if not args.quiet:
+            for r in results:
+                print(json.dumps(r), file=sys.stderr)
+    finally:
+        for peer in peers:
+            peer.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline):
+    """Print the change of each result with respect to a baseline run."""
+    before = {(r["mode"], r["name"]): r for r in baseline["results"]}
+    for r in results:
+        b = before.get((r["mode"], r["name"]))
+        if b is None or not b.get("ops_per_sec") or not r.get("ops_per_sec"):
+            continue
+        print('%-6s %-22s %10.1f ops/s  %+7.1f%%   p99 %9.3f ms (was %9.3f)' % (
+            r["mode"], r["name"], r["ops_per_sec"], 100 * (r["ops_per_sec"] / b["ops_per_sec"] - 1),
+            r["p99_ms"], b["p99_ms"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark bc0lib and a network of local bc0 peers.')
+    parser.add_argument('mode', choices=['micro', 'e2e', 'all'], nargs='?', default='micro')
+    parser.add_argument('--blocks', type=int, default=1000, help='blocks of the synthetic chain')
+    parser.add_argument('--items', type=int, default=10, help='data items in each block')
+    parser.add_argument('--payload', type=int, default=100, help='bytes of data in each data item')
+    parser.add_argument('--format', choices=[bc.FORMAT_JSON, bc.FORMAT_BIN], default=bc.FORMAT_JSON, help='format of the block log')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of each micro benchmark')
+    parser.add_argument('--workers', type=int, default=bc.VERIFY_WORKERS, help='processes verifying a chain')
+    parser.add_argument('--only', nargs='*', help='micro benchmarks to run (all by default)')
+    parser.add_argument('--peers', type=int, default=3, help='local peers of the end-to-end benchmark')
+    parser.add_argument('--port', type=int, default=5101, help='TCP port of the first local peer')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients adding data')
+    parser.add_argument('--requests', type=int, default=50, help='requests sent by each client')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for a response')
+    parser.add_argument('--output', help='file to write the results to, as json (stdout by default)')
+    parser.add_argument('--baseline', help='results of a previous run to be compared with')
+    parser.add_argument('--quiet', action='store_true', help='do not print each result while running')
+    args = parser.parse_args(argv)
+
+    results = []
+    if args.mode in ('micro', 'all'):
+        results.extend(dict(r, mode='micro') for r in run_micro(args))
+    if args.mode in ('e2e', 'all'):
+        results.extend(dict(r, mode='e2e') for r in run_e2e(args))
+    report = {
+        "time": date.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+        "results": results
+    }
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as fin:
+            compare(results, json.load(fin))
+
+
+if __name__ == '__main__':
+    main()
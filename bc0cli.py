@@ -0,0 +1,209 @@
+"""
+This file is part of BC0, Copyright 2018, Luca Mari.
+
+BC0 is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 2.
+
+BC0 is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License <http://www.gnu.org/licenses/> for more details.
+"""
+
+# Command line tools to bulk import data into a blockchain and to verify it, without a server
+import argparse
+import csv
+import datetime as date
+import io
+import json
+import os
+import sys
+import time
+import bc0lib as bc
+
+BLOCK_ITEMS = 1000          # default number of data items sealed in a block
+BLOCK_BYTES = 1 << 20       # default size of the input records sealed in a block
+BATCH_BLOCKS = 100          # default number of blocks written to the block log at a time
+PROGRESS_EVERY = 1.0        # seconds between two progress reports
+
+
+def read_records(fin, fmt, author_field, data_field):
+    """Generate the (author, data, size) of the records of a jsonl or csv input."""
+    if fmt == 'csv':
+        reader = csv.DictReader(fin)
+        for row in reader:
+            author = row.pop(author_field, None)
+            if author is None:
+                raise ValueError('line ' + str(reader.line_num) + ': not a csv row with the field "' + author_field + '"')
+            data = row[data_field] if data_field in row else row
+            yield author, data, sum(len(v) for v in row.values() if v is not None) + len(author)
+        return
+    for n, line in enumerate(fin, 1):
+        if len(line.strip()) == 0:
+            continue
+        try:
+            record = json.loads(line)
+            author = record.pop(author_field)
+        except (ValueError, KeyError, AttributeError):
+            raise ValueError('line ' + str(n) + ': not a json object with the field "' + author_field + '"')
+        data = record[data_field] if data_field in record else record
+        yield author, data, len(line)
+
+
+class Progress:
+    """Report the progress of a long operation on the standard error."""
+
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.start = self.last = time.perf_counter()
+
+    def report(self, records, blocks, force=False):
+        """Report the records and blocks done so far, at most every PROGRESS_EVERY seconds."""
+        now = time.perf_counter()
+        if self.quiet or (not force and now - self.last < PROGRESS_EVERY):
+            return
+        self.last = now
+        elapsed = now - self.start
+        rate = records / elapsed if elapsed > 0 else 0.0
+        print('\r%d records, %d blocks, %.1f s, %.0f records/s' % (records, blocks, elapsed, rate),
+              end='\n' if force else '', file=sys.stderr, flush=True)
+
+
+def import_records(path, records, name=None, author='bc0cli', block_items=BLOCK_ITEMS, block_bytes=BLOCK_BYTES,
+                   batch_blocks=BATCH_BLOCKS, fmt=None, progress=None):
+    """Seal the (author, data, size) records in new blocks of the blockchain
+    stored in the block log at the specified path (created if missing), each
+    block with at most block_items records or about block_bytes of input,
+    writing batch_blocks blocks at a time; Return the numbers of records and blocks added."""
+    if os.path.isfile(path):
+        chain = bc.Blockchain.open(path, tail=True)
+    else:
+        chain = bc.Blockchain(name or os.path.basename(path), author)
+        chain.save(path, fmt)
+    if os.path.isfile(path + bc.POOL_SUFFIX) and bc.Mempool(path).get_num_data_items() > 0:
+        raise ValueError("the chain has data waiting to be sealed in its mempool: seal them first")
+    tip = chain.get_block(chain.get_num_blocks() - 1)
+    previous_hash = tip.hash_me()
+    index = tip.index + 1
+    num_records = num_blocks = 0
+    items, size, blocks = [], 0, []
+
+    def seal():
+        nonlocal items, size, previous_hash, index
+        timestamp = date.datetime.now()
+        for d in items:
+            d.timestamp = str(timestamp)
+        block = bc.Block(index, timestamp, items, previous_hash, chain.hash_version)
+        previous_hash = block.hash_me()
+        index += 1
+        blocks.append(block)
+        items, size = [], 0
+
+    for author_i, data, record_size in records:
+        items.append(bc.DataItem(len(items), '', author_i, data))
+        size += record_size
+        num_records += 1
+        if len(items) >= block_items or size >= block_bytes:
+            seal()
+            if len(blocks) >= batch_blocks:
+                chain.append_blocks(blocks)
+                chain.forget_blocks(chain.get_num_blocks())     # only the last one is needed
+                num_blocks += len(blocks)
+                blocks = []
+                if progress is not None: progress.report(num_records, num_blocks)
+    if len(items) > 0:
+        seal()
+    if len(blocks) > 0:
+        chain.append_blocks(blocks)
+        num_blocks += len(blocks)
+    if progress is not None: progress.report(num_records, num_blocks, force=True)
+    return num_records, num_blocks
+
+
+def cmd_import(args):
+    """Import the records of the input files into a chain."""
+    progress = Progress(args.quiet)
+    total_records = total_blocks = 0
+    for source in args.input:
+        fmt = args.format or ('csv' if source.endswith('.csv') else 'jsonl')
+        fin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8') if source == '-' else open(source, 'r', encoding='utf-8', newline='')
+        with fin:
+            records, blocks = import_records(args.chain, read_records(fin, fmt, args.author_field, args.data_field),
+                                             args.name, args.author, args.block_items, args.block_bytes,
+                                             args.batch_blocks, args.log_format, progress)
+        total_records += records
+        total_blocks += blocks
+    print(json.dumps({"chain": args.chain, "records": total_records, "blocks": total_blocks,
+                      "seconds": round(time.perf_counter() - progress.start, 3)}))
+    return 0
+
+
+def cmd_verify(args):
+    """Verify the integrity of a chain."""
+    start = time.perf_counter()
+    res = bc.verify_chain(args.chain, args.workers, args.chunk_size, args.key)
+    header, offsets, _ = bc.log_extent(args.chain)
+    print(json.dumps({"chain": args.chain, "blocks": header.get("base", 0) + len(offsets), "ok": res == -1,
+                      "first_corrupted": None if res == -1 else res, "seconds": round(time.perf_counter() - start, 3)}))
+    return 0 if res == -1 else 1
+
+
+def cmd_snapshot(args):
+    """Write a snapshot of a chain at its checkpoint, installing it in place of the chain if requested."""
+    if args.key is None:
+        raise ValueError('the key of the checkpoints is needed (--key or BC0_CHECKPOINT_KEY)')
+    snapshot = bc.take_snapshot(args.chain, args.key)
+    if snapshot is None:
+        raise ValueError('the chain has no valid checkpoint: verify it with the same key first')
+    if args.install:
+        bc.install_snapshot(args.chain)
+    header, offsets, _ = bc.log_extent(args.chain if args.install else snapshot)
+    print(json.dumps({"chain": args.chain, "snapshot": None if args.install else snapshot,
+                      "base": header.get("base", 0), "blocks": header.get("base", 0) + len(offsets)}))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk import data into a bc0 blockchain, verify it or snapshot it, without a server.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('import', help='import jsonl or csv records of (author, data) into a chain')
+    p.add_argument('chain', help='the chain file (<name>_<host>_chain), created if missing')
+    p.add_argument('input', nargs='+', help='jsonl or csv files, or - for the standard input')
+    p.add_argument('--format', choices=['jsonl', 'csv'], help='format of the input (from the file extension by default)')
+    p.add_argument('--author-field', default='author', help='field with the author of a record')
+    p.add_argument('--data-field', default='data', help='field with the data of a record (all the other fields if missing)')
+    p.add_argument('--name', help='name of a new chain (from the file name by default)')
+    p.add_argument('--author', default='bc0cli', help='author of the genesis block of a new chain')
+    p.add_argument('--block-items', type=int, default=BLOCK_ITEMS, help='records sealed in a block')
+    p.add_argument('--block-bytes', type=int, default=BLOCK_BYTES, help='bytes of input sealed in a block')
+    p.add_argument('--batch-blocks', type=int, default=BATCH_BLOCKS, help='blocks written at a time')
+    p.add_argument('--log-format', choices=[bc.FORMAT_JSON, bc.FORMAT_BIN], help='format of the block log of a new chain')
+    p.add_argument('--quiet', action='store_true', help='do not show the progress')
+    p.set_defaults(run=cmd_import)
+
+    p = commands.add_parser('verify', help='check the integrity of a chain')
+    p.add_argument('chain', help='the chain file (<name>_<host>_chain)')
+    p.add_argument('--workers', type=int, default=bc.VERIFY_WORKERS, help='processes verifying the chain')
+    p.add_argument('--chunk-size', type=int, default=bc.VERIFY_CHUNK_SIZE, help='blocks verified by a process at a time')
+    p.add_argument('--key', default=os.environ.get('BC0_CHECKPOINT_KEY'),
+                   help='key of the checkpoints, to verify only the blocks after the last one and to write a new one (BC0_CHECKPOINT_KEY by default)')
+    p.set_defaults(run=cmd_verify)
+
+    p = commands.add_parser('snapshot', help='write a copy of a chain without the blocks before its checkpoint')
+    p.add_argument('chain', help='the chain file (<name>_<host>_chain), verified with the key')
+    p.add_argument('--key', default=os.environ.get('BC0_CHECKPOINT_KEY'), help='key of the checkpoints (BC0_CHECKPOINT_KEY by default)')
+    p.add_argument('--install', action='store_true', help='replace the chain with the snapshot, dropping the previous history')
+    p.set_defaults(run=cmd_snapshot)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.run(args)
+    except (OSError, ValueError) as e:
+        print('bc0cli: ' + str(e), file=sys.stderr)
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
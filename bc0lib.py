@@ -13,19 +13,72 @@ See the GNU General Public License <http://www.gnu.org/licenses/> for more detai
 
 # Blockchain with blocks with multiple JSON-structured data entries
 import hashlib as hasher
+import hmac
 import datetime as date
 import json
+import re
+import bisect
+import codecs
+import multiprocessing
+import sys
+import os
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import bc0metrics as metrics
+
+LOG_VERSION = 1         # version of the block log file format
+INDEX_SUFFIX = '.idx'   # suffix of the offset index file of a block log
+CHECKPOINT_SUFFIX = '.ckpt'     # suffix of the checkpoint file of a block log
+SNAPSHOT_SUFFIX = '.snap'       # suffix of the snapshot file of a block log
+POOL_SUFFIX = '.pool'           # suffix of the mempool file of a block log
+QUERY_SUFFIX = '.qidx'          # suffix of the query index file of a block log
+_OFFSET = struct.Struct('>Q')   # an entry of the offset index
+_RECORD_LENGTH = struct.Struct('>I')    # the head of a binary record: the length of the rest of the record
+
+FORMAT_JSON = 'json'    # blocks stored and sent as json records, one per line
+FORMAT_BIN = 'bin'      # blocks stored and sent as length-prefixed binary records
+
+HASH_LEGACY = 1         # blocks hashed on the python repr of their dictionary
+HASH_CANONICAL = 2      # blocks hashed on their canonical encoding
+HASH_MERKLE = 3         # blocks hashed on their header, committing to the merkle root of their data items
+
+VERIFY_WORKERS = os.cpu_count() or 1    # default number of processes verifying a chain
+VERIFY_CHUNK_SIZE = 5000                # default number of blocks verified by a process at a time
+
+SEAL_MAX_ITEMS = 100        # default number of pending data items that triggers sealing a block
+SEAL_MAX_BYTES = 65536      # default size of the pending data items that triggers sealing a block
+SEAL_MAX_AGE = 5.0          # default age in seconds of the oldest pending data item that triggers sealing a block
+
+COMMIT_WINDOW = 0.01        # default seconds for which concurrent requests are gathered to be committed together
+COMMIT_MAX_BATCH = 1000     # default number of requests beyond which a group is committed without waiting
+
+CACHE_BUDGET = 256 * 2**20  # default memory budget in bytes of a cache of loaded files
+CACHE_OVERHEAD = 8          # estimated ratio between the memory used by a loaded file and its size
+
+VIEW_CACHE_BLOCKS = 256     # default number of blocks kept materialized by a lazy view of a block log
+
+QUERY_PAGE_SIZE = 100       # default number of data items in a page of the results of a query
+
+READ_BYTES = metrics.REGISTRY.counter('bc0_chain_read_bytes_total', 'Bytes read from the files of a chain.', ('chain',))
+WRITTEN_BYTES = metrics.REGISTRY.counter('bc0_chain_written_bytes_total', 'Bytes written to the files of a chain.', ('chain',))
+HASH_OPS = metrics.REGISTRY.counter('bc0_hash_ops_total', 'Hashes computed, by kind (block, item, node).', ('kind',))
+OPERATION_SECONDS = metrics.REGISTRY.histogram('bc0_operation_seconds', 'Duration of the operations on chains.', ('op',))
 
 
 class DataItem:
     """Handle a data item, the minimum chunk of information that can be added
     to a block of a blockchain."""
 
+    __slots__ = ("index", "timestamp", "author", "data")
+
     def __init__(self, index, timestamp, author, data):
-        """Class constructor: create a data item."""
+        """Class constructor: create a data item (authors are interned, being shared by many items)."""
         self.index = index
         self.timestamp = str(timestamp)
-        self.author = author
+        self.author = sys.intern(author) if type(author) is str else author
         self.data = data
 
     def dump_me(self):
@@ -43,23 +96,83 @@ class DataItem:
             return dic
         return json.dumps(dic, indent=2) if indented else json.dumps(dic)
 
+    def encode_me(self):
+        """Get the canonical encoding of this data item, as bytes."""
+        return _canonical([self.timestamp, self.author, self.data])
+
+    def hash_me(self):
+        """Get the hash of this data item, as a leaf of the merkle tree of its block (as bytes)."""
+        return hasher.sha256(b'\x00' + self.encode_me()).digest()
+
 
 class Block:
     """Handle a block as the atomic component of a blockchain."""
 
-    def __init__(self, index, timestamp, data, previous_hash):
-        """Class constructor: create and hash a block."""
+    __slots__ = ("index", "timestamp", "data", "previous_hash", "hash_version", "_hash", "_root")
+    _hashed_fields = ("timestamp", "data", "previous_hash", "hash_version")
+
+    def __init__(self, index, timestamp, data, previous_hash, hash_version=HASH_MERKLE):
+        """Class constructor: create and hash a block; the data items can be
+        given as a list or as a dictionary keyed by their indices."""
         self.index = index
         self.timestamp = str(timestamp)
-        self.data = data
+        self.data = [data[i] for i in range(len(data))] if isinstance(data, dict) else list(data)
         self.previous_hash = previous_hash
+        self.hash_version = hash_version
+
+    def __setattr__(self, name, value):
+        """Set an attribute, forgetting the cached hashes if a hashed attribute
+        changes (the data always counts as changed, as it may have been changed in place)."""
+        if name in Block._hashed_fields and (name == "data" or getattr(self, name, None) != value):
+            object.__setattr__(self, "_hash", None)
+            object.__setattr__(self, "_root", None)
+        object.__setattr__(self, name, value)
+
+    def reset_hash(self):
+        """Forget the cached hashes of this block, after its data items have been changed in place."""
+        self._hash = None
+        self._root = None
 
     def hash_me(self):
-        """Generate the hash of this block."""
-        sha = hasher.sha256()
-        to_hash = str(self.dump_me()).encode('utf-8')
-        sha.update(to_hash)
-        return sha.hexdigest()
+        """Get the hash of this block, generating it only if the block has changed."""
+        if self._hash is None:
+            sha = hasher.sha256()
+            if self.hash_version == HASH_LEGACY:
+                to_hash = str(self.dump_me()).encode('utf-8')
+            elif self.hash_version == HASH_MERKLE:
+                to_hash = _canonical(self.get_header())
+            else:
+                to_hash = self.encode_me()
+            sha.update(to_hash)
+            self._hash = sha.hexdigest()
+            HASH_OPS.inc(kind='block')
+        return self._hash
+
+    def encode_me(self):
+        """Get the canonical encoding of this block, as bytes."""
+        items = [self.get_data_item(i) for i in range(self.get_num_data_items())]
+        desc = [self.timestamp, self.previous_hash, [[d.timestamp, d.author, d.data] for d in items]]
+        return _canonical(desc)
+
+    def get_merkle_root(self):
+        """Get the merkle root of the data items of this block, generating it only if the block has changed."""
+        if self._root is None:
+            self._root = merkle_root([d.hash_me() for d in self.data]).hex()
+            HASH_OPS.inc(len(self.data), kind='item')
+        return self._root
+
+    def get_header(self):
+        """Get the header of this block, which is hashed in place of the whole
+        block when the block is hashed on its merkle root."""
+        return [self.timestamp, self.previous_hash, self.get_merkle_root()]
+
+    def get_proof(self, num):
+        """Get the merkle path proving that the specified data item is included
+        in this block, as a list of [side, hash] of the siblings from the leaf up,
+        side being 0 for a left sibling and 1 for a right one; Return None if there is no such item."""
+        if self.get_data_item(num) is None:
+            return None
+        return merkle_path([d.hash_me() for d in self.data], num)
 
     def get_num_data_items(self):
         """Get the number of data items in this block."""
@@ -67,7 +180,7 @@ class Block:
 
     def get_data_item(self, num):
         """Get the specified data item of this chain."""
-        return self.data[num] if num < self.get_num_data_items() else None
+        return self.data[num] if 0 <= num < self.get_num_data_items() else None
 
     def dump_me(self):
         """Get this block as a dictionary."""
@@ -85,63 +198,189 @@ class Block:
             return dic
         return json.dumps(dic, indent=2) if indented else json.dumps(dic)
 
+    def pack_me(self):
+        """Get this block in the binary format: the length of the record, the
+        index as a varint and the previous hash as 32 raw bytes, followed by the
+        other fields of the block and of its data items as a flat compact json
+        array, so that they are decoded at once."""
+        fields = [self.timestamp]
+        for d in self.data:
+            fields += (d.timestamp, d.author, d.data)
+        body = _pack_varint(self.index) + _pack_hash(self.previous_hash) + _COMPACT_ENCODER.encode(fields).encode('utf-8')
+        return _RECORD_LENGTH.pack(len(body)) + body
+
 
 class Blockchain:
     """Handle a blockchain."""
 
-    def __init__(self, name="default name", author="author of genesis block", data="genesis block"):
+    def __init__(self, name="default name", author="author of genesis block", data="genesis block", hash_version=HASH_MERKLE):
         """Class constructor: create and init a blockchain."""
         self.name = name
+        self.hash_version = hash_version
         index = 0
         timestamp = date.datetime.now()
         previous_hash = "0"
         data_item = DataItem(index, timestamp, author, data)
-        data = {index: data_item}
-        block = Block(index, timestamp, data, previous_hash)
-        self.chain = {index: block}
-        self.current_data = {}
+        data = [data_item]
+        block = Block(index, timestamp, data, previous_hash, hash_version)
+        self.chain = [block]    # the blocks from the base on
+        self.current_data = []
+        self.base = 0           # the index of the first block, if older blocks have been pruned
+        self.fmt = FORMAT_JSON  # the format of the records of the block log
+        self.path = None        # the block log of this blockchain, if any
+        self._count = 0         # the number of blocks in the block log
+        self._last = 0          # the offset of the last block in the block log
+        self._end = 0           # the size of the block log
+        self._lock = threading.Lock()   # serializing the appends to the log and the refreshes from it
 
     def get_num_blocks(self):
-        """Get the number of blocks in this blockchain."""
-        return len(self.chain)
+        """Get the number of blocks in this blockchain (including pruned blocks)."""
+        return self.base + len(self.chain)
 
     def get_block(self, num):
         """Get the specified block of this blockchain."""
-        return self.chain[num] if num < self.get_num_blocks() else None
+        return self.chain[num - self.base] if self.base <= num < self.get_num_blocks() else None
 
     def add_data(self, author, data):
         """Add the specified data to the queue of this blockchain."""
         index = len(self.current_data)
         data_item = DataItem(index, date.datetime.now(), author, data)
-        self.current_data.update({index: data_item})
+        self.current_data.append(data_item)
         return data_item
 
     def add_block(self, timestamp):
         """Generate a block and add it to this blockchain."""
         index = self.get_num_blocks()
         previous_hash = self.get_block(index - 1).hash_me()
-        block = Block(index, timestamp, self.current_data, previous_hash)
-        self.chain.update({index: block})
-        self.current_data = {}
+        block = Block(index, timestamp, self.current_data, previous_hash, self.hash_version)
+        self.append_block(block)
+        self.current_data = []
+        return block
+
+    def append_block(self, block):
+        """Append the specified block to this blockchain and, if the blockchain
+        is stored in a block log, to the log, with a single durable write."""
+        self.append_blocks([block])
         return block
-    
+
+    def append_blocks(self, blocks):
+        """Append the specified blocks to this blockchain and, if the blockchain
+        is stored in a block log, to the log, with a single durable write."""
+        with self._lock:    # a concurrent refresh must not load the blocks being appended
+            for k, block in enumerate(blocks):
+                if block.index != self.get_num_blocks() + k:
+                    raise ValueError("block " + str(block.index) + " cannot follow block " + str(self.get_num_blocks() + k - 1))
+                block.hash_version = self.hash_version
+            if self.path is not None and len(blocks) > 0:
+                records = [_encode_record(block, self.fmt) for block in blocks]
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+                try:
+                    offset = os.fstat(fd).st_size
+                    if offset != self._end:
+                        raise IOError("the block log '" + self.path + "' has been changed by someone else")
+                    _write_all(fd, b''.join(records))
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                offsets = []
+                for record in records:
+                    offsets.append(offset)
+                    offset += len(record)
+                count_written(self.path, offset - offsets[0])
+                _append_file(self.path + INDEX_SUFFIX, b''.join(_OFFSET.pack(o) for o in offsets))
+                if os.path.isfile(self.path + QUERY_SUFFIX):
+                    _append_file(self.path + QUERY_SUFFIX, b''.join(_query_record(block) for block in blocks))
+                self._add_offsets(offsets)
+                self._end = offset
+            for block in blocks:
+                self._put_block(block)
+        return blocks
+
+    def _put_block(self, block):
+        """Keep in memory a block appended to this blockchain."""
+        self.chain.append(block)
+
+    def _add_offsets(self, offsets):
+        """Take into account the offsets of the blocks appended to the block log."""
+        self._count += len(offsets)
+        self._last = offsets[-1]
+
+    def _set_blocks(self, blocks, base):
+        """Replace the blocks of this blockchain, starting from the specified index."""
+        self.chain = list(blocks)
+        self.base = base
+
+    def refresh(self):
+        """Load the blocks appended to the block log of this blockchain since it
+        has been opened or last refreshed; Return False if the log has been
+        changed otherwise, so that the blockchain has to be opened again."""
+        with self._lock:    # the blocks being appended by a writer are already in memory
+            start = max(0, self._count - 1)     # only the index past the last known block is read
+            header, offsets, size = log_extent(self.path, start)
+            if header.get("base", 0) > self.base or size < self._end or (self._count > 0 and offsets[:1] != [self._last]):
+                return False
+            if size > self._end:
+                with open(self.path, 'rb') as fin:
+                    fin.seek(self._end)
+                    records, _ = _split_records(fin.read(size - self._end), self.fmt)
+                count_read(self.path, size - self._end)
+                for _, record in records:
+                    block = _decode_record(record, self.fmt)
+                    block.hash_version = self.hash_version
+                    self._put_block(block)
+                self._count = start + len(offsets)
+                self._last = offsets[-1]
+                self._end = size
+            return True
+
+    def forget_blocks(self, num):
+        """Drop from memory the blocks before the specified one, which are
+        then treated as pruned (but are kept in the block log, if any)."""
+        num = min(num, self.get_num_blocks() - 1)
+        if num > self.base:
+            del self.chain[:num - self.base]
+            self.base = num
+
     def add_existing_block(self, block):
         """Add an existing block to this blockchain."""
-        index = self.get_num_blocks()
-        self.chain.update({index: block})
+        block.hash_version = self.hash_version
+        self._put_block(block)
         return block
 
+    def set_hash_version(self, hash_version):
+        """Set how the blocks of this blockchain are hashed."""
+        self.hash_version = hash_version
+        for i in range(self.base, self.get_num_blocks()):
+            self.get_block(i).hash_version = hash_version
+
+    def detect_hash_version(self):
+        """Find how the blocks of this blockchain have been hashed, from the
+        link between the first two blocks, and set it; chains with a single
+        block are hashed on their merkle root."""
+        b = self.base
+        self.set_hash_version(HASH_MERKLE)
+        if self.get_num_blocks() > b + 1:
+            for hash_version in (HASH_MERKLE, HASH_CANONICAL, HASH_LEGACY):
+                self.get_block(b).hash_version = hash_version
+                if self.get_block(b).hash_me() == self.get_block(b + 1).previous_hash:
+                    self.set_hash_version(hash_version)
+                    break
+            else:
+                self.set_hash_version(HASH_MERKLE)      # corrupted anyway
+        return self.hash_version
+
+    @metrics.timed(OPERATION_SECONDS, op='check_me')
     def check_me(self):
         """Check the integrity of this blockchain;
         Return -1 if the chain is ok or the index of the first corrupted block."""
-        for i in range(self.get_num_blocks() - 1):
+        for i in range(self.base, self.get_num_blocks() - 1):
             if self.get_block(i).hash_me() != self.get_block(i + 1).previous_hash:  # check across blocks
                 return i
         return -1
 
     def dump_me(self):
         """Get this blockchain as a dictionary."""
-        block_dic = {i: self.get_block(i).dump_me() for i in range(self.get_num_blocks())}
+        block_dic = {i: self.get_block(i).dump_me() for i in range(self.base, self.get_num_blocks())}
         return block_dic
 
     def write_me(self, jsoned=False, indented=False):
@@ -151,41 +390,1142 @@ class Blockchain:
             return dic
         return json.dumps(dic, indent=2) if indented else json.dumps(dic)
 
+    def pack_me(self):
+        """Get this blockchain in the binary format: a json header line followed by its blocks."""
+        header = {"bc0log": LOG_VERSION, "name": self.name, "hash": self.hash_version, "fmt": FORMAT_BIN}
+        if self.base > 0:
+            header["base"] = self.base
+        blocks = [self.get_block(i).pack_me() for i in range(self.base, self.get_num_blocks())]
+        return (json.dumps(header) + '\n').encode('utf-8') + b''.join(blocks)
 
-def load_block(desc):
-    desc = json.loads(desc)
-    i = list(desc.keys())[0]
-    di = desc[i]
-    block = Block(i, di["ts"], {}, di["ph"])
+    @metrics.timed(OPERATION_SECONDS, op='save')
+    def save(self, path, fmt=None):
+        """Write this blockchain as a new block log at the specified path, in the
+        specified format (or in the current one), atomically replacing any
+        previous content, and bind it to the log."""
+        if fmt is not None:
+            self.fmt = fmt
+        header = {"bc0log": LOG_VERSION, "name": self.name, "hash": self.hash_version}
+        if self.base > 0:
+            header["base"] = self.base
+        if self.fmt != FORMAT_JSON:
+            header["fmt"] = self.fmt
+        records = [(json.dumps(header) + '\n').encode('utf-8')]
+        offsets = []
+        end = len(records[0])
+        for i in range(self.base, self.get_num_blocks()):
+            record = _encode_record(self.get_block(i), self.fmt)
+            records.append(record)
+            offsets.append(end)
+            end += len(record)
+        with self._lock:
+            _replace_file(path, b''.join(records))
+            _replace_file(path + INDEX_SUFFIX, b''.join(_OFFSET.pack(o) for o in offsets))
+            _replace_file(path + QUERY_SUFFIX, b''.join(_query_record(self.get_block(i)) for i in range(self.base, self.get_num_blocks())))
+            if os.path.isfile(path + CHECKPOINT_SUFFIX):    # verified for another content
+                os.remove(path + CHECKPOINT_SUFFIX)
+            self.path = path
+            self._count = len(offsets)
+            self._last = offsets[-1]
+            self._end = end
+
+    @classmethod
+    @metrics.timed(OPERATION_SECONDS, op='open')
+    def open(cls, path, tail=False, lazy=False):
+        """Open the blockchain stored in the block log at the specified path;
+        a legacy single-JSON chain file is migrated to a block log first;
+        if tail, only the last block is loaded, enough to append new blocks;
+        if lazy, a view is returned, loading the blocks only when requested."""
+        if lazy:
+            return BlockLogView(path)
+        if tail:    # only the last entry of the index is read
+            header, offsets, size = log_extent(path, -1)
+            with open(path, 'rb') as fin:
+                fin.seek(offsets[-1])
+                block = _decode_record(fin.read(size - offsets[-1]), log_format(header))
+            count_read(path, size - offsets[-1])
+            blockchain = cls(header["name"], hash_version=header.get("hash", HASH_LEGACY))
+            blockchain.fmt = log_format(header)
+            block.hash_version = blockchain.hash_version
+            blockchain._set_blocks([block], block.index)
+            blockchain.path = path
+            blockchain._count = block.index + 1 - header.get("base", 0)
+            blockchain._last = offsets[-1]
+            blockchain._end = size
+            return blockchain
+        if not is_block_log(path):
+            migrate_chain_file(path)
+        with open(path, 'rb') as fin:
+            content = fin.read()
+        count_read(path, len(content))
+        pos = content.index(b'\n') + 1
+        header = json.loads(content[:pos].decode('utf-8'))
+        blockchain = cls(header["name"], hash_version=header.get("hash", HASH_LEGACY))
+        blockchain._set_blocks([], header.get("base", 0))
+        blockchain.fmt = log_format(header)
+        offsets = []
+        records, pos = _split_records(content, blockchain.fmt, pos)
+        for offset, record in records:
+            block = _decode_record(record, blockchain.fmt)
+            block.hash_version = blockchain.hash_version
+            blockchain._put_block(block)
+            offsets.append(offset)
+        if pos < len(content):      # drop the torn tail of the log: the record has not been completed
+            with open(path, 'r+b') as fout:
+                fout.truncate(pos)
+                os.fsync(fout.fileno())
+        if _read_offsets(path + INDEX_SUFFIX) != offsets:   # rebuild a stale index
+            _replace_file(path + INDEX_SUFFIX, b''.join(_OFFSET.pack(o) for o in offsets))
+        blockchain.path = path
+        blockchain._count = len(offsets)
+        blockchain._last = offsets[-1]
+        blockchain._end = pos
+        return blockchain
+
+
+class BlockLogView(Blockchain):
+    """Handle a lazy view of the blockchain stored in a block log, which reads
+    a block from the log only when it is requested, keeping in memory only
+    the most recently requested blocks."""
+
+    def __init__(self, path, cache_size=VIEW_CACHE_BLOCKS):
+        """Class constructor: open the view of the block log at the specified path."""
+        header, offsets, size = log_extent(path)
+        self.name = header["name"]
+        self.hash_version = header.get("hash", HASH_LEGACY)
+        self.base = header.get("base", 0)
+        self.fmt = log_format(header)
+        self.chain = OrderedDict()      # the materialized blocks, by index
+        self.cache_size = cache_size
+        self.current_data = []
+        self.path = path
+        self._offsets = offsets
+        self._end = size
+        self._lock = threading.Lock()
+
+    def get_num_blocks(self):
+        """Get the number of blocks in this blockchain (including pruned blocks)."""
+        return self.base + len(self._offsets)
+
+    def get_block(self, num):
+        """Get the specified block of this blockchain, reading it from the log if needed."""
+        if not self.base <= num < self.get_num_blocks():
+            return None
+        block = self.chain.get(num)
+        if block is None:
+            k = num - self.base
+            begin = self._offsets[k]
+            end = self._offsets[k + 1] if k + 1 < len(self._offsets) else self._end
+            with open(self.path, 'rb') as fin:
+                fin.seek(begin)
+                block = _decode_record(fin.read(end - begin), self.fmt)
+            count_read(self.path, end - begin)
+            block.hash_version = self.hash_version
+            self.chain[num] = block
+            while len(self.chain) > self.cache_size:
+                self.chain.popitem(last=False)
+        else:
+            self.chain.move_to_end(num)
+        return block
+
+    def refresh(self):
+        """Take into account the blocks appended to the block log since the view
+        has been opened or last refreshed; Return False if the log has been
+        changed otherwise, so that the view has to be opened again."""
+        with self._lock:
+            n = len(self._offsets)
+            header, offsets, size = log_extent(self.path, max(0, n - 1))    # only the index past the last known block is read
+            if header.get("base", 0) != self.base or size < self._end or (n > 0 and offsets[:1] != self._offsets[-1:]):
+                return False
+            self._offsets.extend(offsets[1:] if n > 0 else offsets)
+            self._end = size
+            return True
+
+    def _add_offsets(self, offsets):
+        """Take into account the offsets of the blocks appended to the block log."""
+        self._offsets.extend(offsets)
+
+    def forget_blocks(self, num):
+        """Drop from memory the materialized blocks."""
+        self.chain.clear()
+
+    def _put_block(self, block):
+        """Keep in memory a block appended to this view, as a materialized block."""
+        self.chain[block.index] = block
+        while len(self.chain) > self.cache_size:
+            self.chain.popitem(last=False)
+
+
+class Mempool:
+    """Handle the data items waiting to be sealed in a block of the blockchain
+    stored in a block log, persisted in a file next to the log."""
+
+    def __init__(self, path, meta=None):
+        """Class constructor: load the mempool of the block log at the specified
+        path, creating it with the specified metadata if it does not exist."""
+        self.path = path + POOL_SUFFIX
+        self.items = []
+        self.size = 0
+        try:
+            with open(self.path, 'rb') as fin:
+                content = fin.read()
+        except OSError:
+            content = b''
+        lines = content.split(b'\n')
+        if len(lines[-1]) > 0 and len(lines) > 1:     # drop a torn write
+            with open(self.path, 'r+b') as fout:
+                fout.truncate(len(content) - len(lines[-1]))
+        if len(lines) > 1:
+            self.meta = json.loads(lines[0].decode('utf-8'))["meta"]
+            for line in lines[1:-1]:    # the last line is empty or a torn write
+                di = json.loads(line.decode('utf-8'))
+                self.items.append(DataItem(len(self.items), di["ts"], di["au"], di["da"]))
+                self.size += len(line) + 1
+        else:
+            self.meta = meta if meta is not None else {}
+            self._clear()
+
+    def get_num_data_items(self):
+        """Get the number of data items in this mempool."""
+        return len(self.items)
+
+    def get_age(self):
+        """Get the age in seconds of the oldest data item in this mempool."""
+        if len(self.items) == 0:
+            return 0.0
+        return (date.datetime.now() - date.datetime.fromisoformat(self.items[0].timestamp)).total_seconds()
+
+    def add_data(self, author, data):
+        """Durably add the specified data to this mempool."""
+        return self.add_data_items([(author, data)])[0]
+
+    def add_data_items(self, entries):
+        """Durably add the specified (author, data) entries to this mempool,
+        with a single write; Return the new data items."""
+        now = date.datetime.now()
+        data_items = [DataItem(len(self.items) + k, now, author, data) for k, (author, data) in enumerate(entries)]
+        records = [(json.dumps(data_item.dump_me()) + '\n').encode('utf-8') for data_item in data_items]
+        _append_file(self.path, b''.join(records))
+        self.items.extend(data_items)
+        self.size += sum(len(record) for record in records)
+        return data_items
+
+    def is_due(self, max_items=SEAL_MAX_ITEMS, max_bytes=SEAL_MAX_BYTES, max_age=SEAL_MAX_AGE):
+        """Tell whether the data items of this mempool are to be sealed in a block."""
+        return len(self.items) > 0 and (len(self.items) >= max_items or self.size >= max_bytes or self.get_age() >= max_age)
+
+    def seal(self, blockchain, timestamp):
+        """Seal the data items of this mempool in a new block of the specified
+        blockchain, and empty the mempool; Return the block, or None if empty."""
+        tip = blockchain.get_block(blockchain.get_num_blocks() - 1)
+        if [d.dump_me() for d in self.items] == [tip.get_data_item(i).dump_me() for i in range(tip.get_num_data_items())]:
+            self._clear()       # already sealed, but the mempool had not been emptied
+            return None
+        if len(self.items) == 0:
+            return None
+        blockchain.current_data = list(self.items)
+        block = blockchain.add_block(timestamp)
+        self._clear()
+        return block
+
+    def _clear(self):
+        """Empty this mempool."""
+        self.items = []
+        self.size = 0
+        _replace_file(self.path, (json.dumps({"bc0pool": 1, "meta": self.meta}) + '\n').encode('utf-8'))
+
+
+class GroupCommit:
+    """Handle the commits of concurrent requests on the same key (e.g. a chain):
+    a request alone on its key is committed at once, while under contention
+    the first request waits for a short window, gathering the requests that
+    arrive meanwhile, and then commits all of them with a single call."""
+
+    def __init__(self, commit, window=COMMIT_WINDOW, max_batch=COMMIT_MAX_BATCH):
+        """Class constructor: commit(key, requests) must commit a group of
+        requests, returning a result for each of them."""
+        self.commit = commit
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.groups = {}        # key -> the group gathering requests
+        self.active = {}        # key -> the number of requests being submitted
+        self.commits = self.requests = 0
+
+    def submit(self, key, request):
+        """Commit a request together with the concurrent ones on the same key;
+        Return its result, or raise the error of the commit."""
+        with self.lock:
+            self.active[key] = self.active.get(key, 0) + 1
+            alone = self.active[key] == 1
+            group = self.groups.get(key)
+            leader = group is None
+            if leader:
+                group = self.groups[key] = _Group()
+            num = len(group.requests)
+            group.requests.append(request)
+            if len(group.requests) >= self.max_batch:
+                del self.groups[key]
+                group.full.set()
+        try:
+            if leader:
+                if not alone:   # other requests are in flight: gather the ones arriving meanwhile
+                    group.full.wait(self.window)
+                with self.lock:
+                    if self.groups.get(key) is group:
+                        del self.groups[key]
+                    self.commits += 1
+                    self.requests += len(group.requests)
+                try:
+                    group.results = self.commit(key, group.requests)
+                except Exception as e:
+                    group.error = e
+                group.done.set()
+            else:
+                group.done.wait()
+        finally:
+            with self.lock:
+                self.active[key] -= 1
+                if self.active[key] == 0:
+                    del self.active[key]
+        if group.error is not None:
+            raise group.error
+        return group.results[num]
+
+    def stats(self):
+        """Get the number of commits and of committed requests."""
+        with self.lock:
+            return {"commits": self.commits, "requests": self.requests}
+
+
+class _Group:
+    """Handle a group of requests to be committed together."""
+
+    def __init__(self):
+        self.requests = []
+        self.results = None
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class ItemIndex:
+    """Handle the query index of a block log, stored next to it as a json line
+    for each block with its timestamp and the author and timestamp of its data
+    items, and kept in memory as sorted lists to be searched by bisection; the
+    data items are found by the timestamp of their block (the time they were
+    sealed), which orders them as the chain does."""
+
+    def __init__(self, path):
+        """Class constructor: create an empty query index of the block log at the specified path."""
+        self.path = path
+        self.authors = {}       # author -> sorted list of (block timestamp, block, item)
+        self.times = []         # sorted list of (block timestamp, block, number of data items)
+        self.counts = [0]       # the number of data items in the blocks before each one in times, and in all of them
+        self.height = None      # the index of the last indexed block
+        self._end = 0           # the size of the index file read so far
+
+    @classmethod
+    def open(cls, path):
+        """Load the query index of the block log at the specified path,
+        rebuilding it if it is missing or it does not match the log."""
+        index = cls(path)
+        if not index.refresh():
+            _replace_file(path + QUERY_SUFFIX, b'')
+            index = cls(path)
+            if not index.refresh():
+                raise ValueError("the query index of '" + path + "' cannot be built")
+        return index
+
+    def refresh(self):
+        """Read the entries appended to the index file since it was read, and
+        index the blocks appended to the block log but not to the index file;
+        Return False if the index file does not match the log."""
+        try:
+            with open(self.path + QUERY_SUFFIX, 'rb') as fin:
+                fin.seek(self._end)
+                content = fin.read()
+        except OSError:
+            return False
+        header, offsets, _ = log_extent(self.path)
+        if self.height is None:
+            self.height = header.get("base", 0) - 1
+        end = content.rfind(b'\n') + 1     # a torn last line is read again
+        try:
+            for line in content[:end].splitlines():
+                entry = json.loads(line.decode('utf-8'))
+                if entry[0] <= self.height:     # indexed twice
+                    continue
+                if entry[0] != self.height + 1:
+                    return False
+                self._add(entry)
+        except (ValueError, TypeError, IndexError):
+            return False
+        self._end += end
+        num_blocks = header.get("base", 0) + len(offsets)
+        if self.height >= num_blocks:
+            return False
+        if self.height < num_blocks - 1:     # appended to the log only
+            view = BlockLogView(self.path)
+            records = b''.join(_query_record(view.get_block(i)) for i in range(self.height + 1, num_blocks))
+            if end < len(content):
+                _replace_file(self.path + QUERY_SUFFIX, self._read_all()[:self._end] + records)
+            else:
+                _append_file(self.path + QUERY_SUFFIX, records)
+            for line in records.splitlines():
+                self._add(json.loads(line.decode('utf-8')))
+            self._end += len(records)
+        return True
+
+    def find(self, author=None, since=None, until=None, offset=0, limit=QUERY_PAGE_SIZE):
+        """Find the data items of the specified author (or of any author) in the
+        blocks with timestamps in the specified range [since, until), in order of time;
+        Return the total number of such items and a page of them, as (block, item)."""
+        if author is not None:
+            entries = self.authors.get(author, [])
+            lo = 0 if since is None else bisect.bisect_left(entries, (since,))
+            hi = len(entries) if until is None else bisect.bisect_left(entries, (until,))
+            return max(0, hi - lo), [(b, i) for _, b, i in entries[lo + offset:min(hi, lo + offset + limit)]]
+        lo = 0 if since is None else bisect.bisect_left(self.times, (since,))
+        hi = len(self.times) if until is None else bisect.bisect_left(self.times, (until,))
+        total = self.counts[hi] - self.counts[lo]
+        start = self.counts[lo] + offset
+        k = bisect.bisect_right(self.counts, start) - 1     # the block with the first item of the page
+        page = []
+        while k < hi and len(page) < limit:
+            _, b, n = self.times[k]
+            first = start - self.counts[k] if len(page) == 0 else 0
+            page.extend((b, i) for i in range(first, min(n, first + limit - len(page))))
+            k += 1
+        return total, page
+
+    def _add(self, entry):
+        """Index a block, given as [index, timestamp, [[author, timestamp], ...]]."""
+        num, timestamp, items = entry
+        pos = bisect.bisect(self.times, (timestamp, num, len(items)))
+        self.times.insert(pos, (timestamp, num, len(items)))
+        if pos == len(self.times) - 1:
+            self.counts.append(self.counts[-1] + len(items))
+        else:   # out of order (the clocks of the hosts differ): count again from the block
+            del self.counts[pos + 1:]
+            for _, _, n in self.times[pos:]:
+                self.counts.append(self.counts[-1] + n)
+        for i, (author, _) in enumerate(items):
+            bisect.insort(self.authors.setdefault(author, []), (timestamp, num, i))
+        self.height = num
+
+    def _read_all(self):
+        """Get the content of the index file."""
+        with open(self.path + QUERY_SUFFIX, 'rb') as fin:
+            return fin.read()
+
+
+def _query_record(block):
+    """Get the entry of the query index for a block, as a json line."""
+    items = [[block.get_data_item(i).author, block.get_data_item(i).timestamp] for i in range(block.get_num_data_items())]
+    return (json.dumps([block.index, block.timestamp, items]) + '\n').encode('utf-8')
+
+
+class FileCache:
+    """Handle a cache of objects loaded from files, invalidated when the files
+    change, evicting the least recently used objects beyond a memory budget."""
+
+    def __init__(self, budget=CACHE_BUDGET, overhead=CACHE_OVERHEAD):
+        """Class constructor: create an empty cache."""
+        self.budget = budget
+        self.overhead = overhead
+        self.entries = OrderedDict()    # path -> [signature, cost, object]
+        self.used = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+        self.path_locks = {}
+
+    def get(self, path, load, reload=None):
+        """Get the object loaded from the specified file, calling load(path) if
+        the file is not cached or it has changed; if the file has been changed
+        in place, reload(object) is tried first, to update the cached object
+        (returning False if it cannot)."""
+        with self.lock:
+            path_lock = self.path_locks.setdefault(path, threading.Lock())
+        with path_lock:     # a file is loaded once, even if requested by many threads
+            st = os.stat(path)
+            sig = (st.st_ino, st.st_mtime_ns, st.st_size)
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry is not None and entry[0] == sig:
+                    self.entries.move_to_end(path)
+                    self.hits += 1
+                    return entry[2]
+                self.misses += 1
+            if entry is not None and entry[0][0] == sig[0] and reload is not None and reload(entry[2]):
+                obj = entry[2]
+            else:
+                obj = load(path)
+            self.put(path, obj, sig)
+            return obj
+
+    def put(self, path, obj, sig=None):
+        """Store an object loaded from the specified file."""
+        if sig is None:
+            st = os.stat(path)
+            sig = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cost = sig[2] * self.overhead
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.used -= old[1]
+            if cost > self.budget:
+                return
+            self.entries[path] = [sig, cost, obj]
+            self.used += cost
+            while self.used > self.budget:
+                _, (_, c, _) = self.entries.popitem(last=False)
+                self.used -= c
+                self.evictions += 1
+
+    def invalidate(self, path):
+        """Forget the object loaded from the specified file."""
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.used -= entry[1]
+
+    def stats(self):
+        """Get the counters of this cache."""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self.entries), "bytes": self.used, "budget": self.budget}
+
+
+@metrics.timed(OPERATION_SECONDS, op='verify_chain')
+def verify_chain(path, workers=None, chunk_size=None, key=None):
+    """Check the integrity of the blockchain stored in the block log at the
+    specified path, hashing ranges of blocks in parallel processes;
+    if a key is specified, only the blocks after the checkpoint signed with
+    the key are checked, and the checkpoint is then moved to the last block;
+    Return -1 if the chain is ok or the index of the first corrupted block."""
+    workers = VERIFY_WORKERS if workers is None else max(1, workers)
+    chunk_size = VERIFY_CHUNK_SIZE if chunk_size is None else max(2, chunk_size)
+    header, offsets, size = log_extent(path)
+    hash_version = header.get("hash", HASH_LEGACY)
+    base = header.get("base", 0)
+    start = 0       # the position in the log of the first block to check
+    checkpoint = read_checkpoint(path, key) if key is not None else None
+    if checkpoint is not None and base <= checkpoint[0] < base + len(offsets):
+        start = checkpoint[0] - base
+        end = offsets[start + 1] if start + 1 < len(offsets) else size
+        if _verify_range(path, hash_version, checkpoint[0], offsets[start], end)[2] != checkpoint[1]:
+            start = 0       # the verified blocks have been changed: check them all again
+    ranges = []
+    for first in range(start, len(offsets), chunk_size):
+        last = min(first + chunk_size, len(offsets))
+        end = offsets[last] if last < len(offsets) else size
+        ranges.append((path, hash_version, base + first, offsets[first], end))
+    if workers == 1 or len(ranges) <= 1:
+        results = [_verify_range(*r) for r in ranges]
+    else:
+        try:
+            counted = list(verify_pool(workers).map(_verify_range_counted, *zip(*ranges)))
+        except BrokenProcessPool:       # a process has died: a new pool is started by the next verification
+            with _verify_pools_lock:
+                _verify_pools.pop(workers, None)
+            raise
+        results = [res for res, _ in counted]
+        for _, counts in counted:      # the hashes computed by the other processes
+            for kind, n in counts.items():
+                HASH_OPS.inc(n, kind=kind)
+    for k, (bad, first_ph, last_hash, last) in enumerate(results):
+        if bad != -1:
+            return bad
+        if k + 1 < len(results) and results[k + 1][1] != last_hash:     # check across ranges
+            return last
+    if key is not None and len(results) > 0:
+        write_checkpoint(path, results[-1][3], results[-1][2], key)
+    return -1
+
+
+_verify_pools = {}      # number of processes -> long-lived pool of processes verifying chains
+_verify_pools_lock = threading.Lock()
+
+
+def verify_pool(workers=VERIFY_WORKERS):
+    """Get the pool of processes verifying chains with the specified number of
+    processes, creating it at the first use; its processes are started by a
+    fork server (or spawned where there is none) rather than forked, which
+    would be unsafe in a multithreaded server."""
+    with _verify_pools_lock:
+        pool = _verify_pools.get(workers)
+        if pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            pool = _verify_pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+        return pool
+
+
+def log_extent(path, start=0):
+    """Get the header, the offsets of the blocks (from the start-th one, or the
+    last -start ones if negative, reading only that part of the index) and the
+    size of the block log at the specified path, migrating the chain or
+    repairing its index if needed."""
+    offsets = _read_offsets(path + INDEX_SUFFIX, start) if is_block_log(path) else None
+    size = os.path.getsize(path)
+    if offsets is not None and len(offsets) > 0 and offsets[-1] < size:
+        header = _read_header(path)
+        with open(path, 'rb') as fin:
+            fin.seek(offsets[-1])
+            last = fin.read(size - offsets[-1])
+        records, end = _split_records(last, log_format(header))
+        if len(records) == 1 and end == len(last):     # the index points to the last record
+            return header, offsets, size
+    blockchain = Blockchain.open(path)      # the index is rebuilt if stale
+    return _read_header(path), _read_offsets(path + INDEX_SUFFIX, start), blockchain._end
+
+
+def stream_blocks(path, first=0, last=None, chunk_size=65536, fmt=None):
+    """Generate the bytes of the block log at the specified path, with a header
+    line and the records of the blocks from first to last (excluded), in chunks;
+    the records are converted if a format other than the one of the log is specified."""
+    header, offsets, size = log_extent(path)
+    base = header.get("base", 0)
+    log_fmt = log_format(header)
+    fmt = log_fmt if fmt is None else fmt
+    num_blocks = base + len(offsets)
+    first = max(first, base)
+    last = num_blocks if last is None else min(max(last, first), num_blocks)
+    header.update({"from": first, "to": last, "fmt": fmt})
+    yield (json.dumps(header) + '\n').encode('utf-8')
+    if first >= last:
+        return
+    begin = offsets[first - base]
+    end = offsets[last - base] if last < num_blocks else size
+    with open(path, 'rb') as fin:
+        fin.seek(begin)
+        pending = b''
+        while begin < end:
+            chunk = fin.read(min(chunk_size, end - begin))
+            if len(chunk) == 0:
+                break
+            count_read(path, len(chunk))
+            begin += len(chunk)
+            if fmt == log_fmt:
+                yield chunk
+                continue
+            records, pos = _split_records(pending + chunk, log_fmt)
+            pending = (pending + chunk)[pos:]
+            yield b''.join(_encode_record(_decode_record(r, log_fmt), fmt) for _, r in records)
+
+
+def read_blocks(chunks):
+    """Generate the header (as a dictionary) and then the blocks read from a
+    stream of chunks of bytes, as generated by stream_blocks."""
+    pending = b''
+    header = None
+    for chunk in chunks:
+        pending += chunk
+        if header is None:
+            nl = pending.find(b'\n')
+            if nl < 0:
+                continue
+            header = json.loads(pending[:nl].decode('utf-8'))
+            fmt = log_format(header)
+            yield header
+            pending = pending[nl + 1:]
+        records, pos = _split_records(pending, fmt)
+        pending = pending[pos:]
+        for _, record in records:
+            yield _decode_record(record, fmt)
+    if header is None or len(pending.strip()) > 0:
+        raise ValueError("the stream of blocks has been truncated")
+
+
+_CANONICAL_ENCODER = json.JSONEncoder(sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+_COMPACT_ENCODER = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+
+def _canonical(desc):
+    """Get the canonical encoding of a json-serializable description, as bytes."""
+    return _CANONICAL_ENCODER.encode(desc).encode('utf-8')
+
+
+def _merkle_node(left, right):
+    """Get the hash of an inner node of a merkle tree (as bytes)."""
+    return hasher.sha256(b'\x01' + left + right).digest()
+
+
+def merkle_root(leaves):
+    """Get the root of the merkle tree with the specified leaf hashes (as bytes);
+    a node without a sibling is promoted unchanged to the upper level."""
+    if len(leaves) == 0:
+        return hasher.sha256(b'').digest()
+    HASH_OPS.inc(len(leaves) - 1, kind='node')     # the inner nodes of the tree
+    level = list(leaves)
+    while len(level) > 1:
+        level = [_merkle_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def merkle_path(leaves, num):
+    """Get the path from the specified leaf to the root of the merkle tree with
+    the specified leaf hashes, as a list of [side, hash] of the siblings."""
+    path = []
+    level = list(leaves)
+    while len(level) > 1:
+        sibling = num ^ 1
+        if sibling < len(level):
+            path.append([0 if sibling < num else 1, level[sibling].hex()])
+        level = [_merkle_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+        num //= 2
+    return path
+
+
+def check_proof(item, path, header):
+    """Check that a data item, given as a dictionary, is included in the block
+    with the specified header, following its merkle path;
+    Return the hash of the block if the proof is ok, or None."""
+    node = DataItem(0, item["ts"], item["au"], item["da"]).hash_me()
+    for side, sibling in path:
+        node = _merkle_node(bytes.fromhex(sibling), node) if side == 0 else _merkle_node(node, bytes.fromhex(sibling))
+    if node.hex() != header[2]:
+        return None
+    return hasher.sha256(_canonical(header)).hexdigest()
+
+
+def _sign_checkpoint(name, height, block_hash, key):
+    """Get the signature of a checkpoint."""
+    msg = (name + ':' + str(height) + ':' + block_hash).encode('utf-8')
+    return hmac.new(key.encode('utf-8'), msg, hasher.sha256).hexdigest()
+
+
+def write_checkpoint(path, height, block_hash, key):
+    """Record that the blockchain stored in the block log at the specified path
+    has been verified up to the specified block, with the specified hash,
+    signing the checkpoint with the specified key."""
+    name = _read_header(path)["name"]
+    checkpoint = {"height": height, "hash": block_hash, "sig": _sign_checkpoint(name, height, block_hash, key)}
+    _replace_file(path + CHECKPOINT_SUFFIX, json.dumps(checkpoint).encode('utf-8'))
+
+
+def read_checkpoint(path, key):
+    """Get the height and the hash of the last verified block of the blockchain
+    stored in the block log at the specified path, or None if there is no
+    checkpoint or its signature is wrong."""
+    try:
+        with open(path + CHECKPOINT_SUFFIX, 'rb') as fin:
+            checkpoint = json.loads(fin.read().decode('utf-8'))
+        height, block_hash = checkpoint["height"], checkpoint["hash"]
+        sig = _sign_checkpoint(_read_header(path)["name"], height, block_hash, key)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if not hmac.compare_digest(sig, checkpoint.get("sig", "")):
+        return None
+    return height, block_hash
+
+
+def take_snapshot(path, key):
+    """Write a snapshot of the blockchain stored in the block log at the
+    specified path, as a block log pruned of the blocks before its checkpoint
+    and with the same checkpoint, so that it can be opened and checked
+    without reading nor verifying the previous history;
+    Return the path of the snapshot, or None if there is no valid checkpoint."""
+    checkpoint = read_checkpoint(path, key)
+    if checkpoint is None:
+        return None
+    blockchain = Blockchain.open(path)
+    height = checkpoint[0]
+    if blockchain.get_block(height) is None or blockchain.get_block(height).hash_me() != checkpoint[1]:
+        return None
+    blockchain._set_blocks([blockchain.get_block(i) for i in range(height, blockchain.get_num_blocks())], height)
+    snapshot = path + SNAPSHOT_SUFFIX
+    blockchain.save(snapshot)
+    write_checkpoint(snapshot, height, checkpoint[1], key)
+    return snapshot
+
+
+def install_snapshot(path):
+    """Replace the blockchain stored in the block log at the specified path
+    (with its index, checkpoint and query index) with its snapshot, dropping
+    the history before the checkpoint."""
+    snapshot = path + SNAPSHOT_SUFFIX
+    if not os.path.isfile(snapshot):
+        raise OSError("no snapshot of the block log '" + path + "'")
+    for suffix in (INDEX_SUFFIX, CHECKPOINT_SUFFIX, QUERY_SUFFIX, ''):     # the log last, when its side files are in place
+        if os.path.isfile(snapshot + suffix):
+            os.replace(snapshot + suffix, path + suffix)
+
+
+def _verify_range(path, hash_version, first, begin, end):
+    """Check the blocks stored in a byte range of a block log, starting from
+    the specified block; Return the index of the first corrupted block or -1,
+    the previous hash of the first block, the hash of the last block and its index."""
+    with open(path, 'rb') as fin:
+        fin.seek(begin)
+        content = fin.read(end - begin)
+    fmt = log_format(_read_header(path))
+    records, pos = _split_records(content, fmt)
+    records = [r for _, r in records]
+    if pos < len(content):
+        records.append(content[pos:])
+    first_ph = last_hash = None
+    for k, record in enumerate(records):
+        i = first + k
+        try:
+            block = _decode_record(record, fmt)
+        except (ValueError, KeyError, TypeError, IndexError):
+            return i, first_ph, last_hash, i    # the block cannot even be read
+        block.hash_version = hash_version
+        if k == 0:
+            first_ph = block.previous_hash
+        elif block.previous_hash != last_hash:      # check across blocks
+            return i - 1, first_ph, last_hash, i
+        last_hash = block.hash_me()
+    return -1, first_ph, last_hash, first + len(records) - 1
+
+
+def _verify_range_counted(path, hash_version, first, begin, end):
+    """Check the blocks stored in a byte range of a block log, in another process;
+    Return the result of _verify_range and the hashes computed, by kind."""
+    with HASH_OPS.lock:
+        before = dict(HASH_OPS.values)
+    res = _verify_range(path, hash_version, first, begin, end)
+    with HASH_OPS.lock:
+        after = dict(HASH_OPS.values)
+    return res, {key[0]: n - before.get(key, 0) for key, n in after.items() if n != before.get(key, 0)}
+
+
+def _read_header(path):
+    """Read the header of a block log."""
+    with open(path, 'rb') as fin:
+        return json.loads(fin.readline().decode('utf-8'))
+
+
+def _write_all(fd, data):
+    """Write all the specified bytes to the specified file descriptor."""
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+
+
+def _append_file(path, data):
+    """Durably append the specified bytes to a (possibly new) file."""
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        _write_all(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    count_written(path, len(data))
+
+
+def _replace_file(path, data):
+    """Durably and atomically replace the content of a file."""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fout:
+        fout.write(data)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp, path)
+    count_written(path, len(data))
+
+
+_SIDE_SUFFIX = re.compile(r'(\.snap)?(\.idx|\.ckpt|\.pool|\.qidx)?$')
+
+
+def chain_label(path):
+    """Get the name of the chain file a (possibly side) file belongs to, to label its metrics."""
+    return _SIDE_SUFFIX.sub('', os.path.basename(path), count=1)
+
+
+def count_read(path, n):
+    """Count the bytes read from a file of a chain."""
+    READ_BYTES.inc(n, chain=chain_label(path))
+
+
+def count_written(path, n):
+    """Count the bytes written to a file of a chain."""
+    WRITTEN_BYTES.inc(n, chain=chain_label(path))
+
+
+def _read_offsets(path, start=0):
+    """Read an offset index from the start-th offset (or the last -start ones
+    if negative), or None if it is missing."""
+    try:
+        with open(path, 'rb') as fin:
+            num = os.fstat(fin.fileno()).st_size // _OFFSET.size
+            fin.seek(_OFFSET.size * min(num, max(0, start if start >= 0 else num + start)))
+            data = fin.read()
+    except OSError:
+        return None
+    return [o for (o,) in _OFFSET.iter_unpack(data[:len(data) - len(data) % _OFFSET.size])]
+
+
+def log_format(header):
+    """Get the format of the records of a block log (or of a stream of blocks) from its header."""
+    return header.get("fmt", FORMAT_JSON)
+
+
+def is_block_log(path):
+    """Tell whether the specified file is a block log (and not a legacy chain file)."""
+    with open(path, 'rb') as fin:
+        line = fin.readline()
+    try:
+        header = json.loads(line.decode('utf-8'))
+    except ValueError:
+        return False
+    return isinstance(header, dict) and "bc0log" in header
+
+
+def migrate_chain_file(path, fmt=FORMAT_JSON):
+    """Convert a legacy single-JSON chain file into a block log, in place;
+    Return False if the file is already a block log."""
+    if is_block_log(path):
+        return False
+    with open(path, 'r') as fin:
+        content = fin.read()
+    count_read(path, len(content))
+    blockchain = load_blockchain(content)
+    blockchain.save(path, fmt)
+    return True
+
+
+def chain_files(path):
+    """Get the files storing the blockchain at the specified path."""
+    return [path, path + INDEX_SUFFIX, path + CHECKPOINT_SUFFIX, path + POOL_SUFFIX, path + QUERY_SUFFIX,
+            path + SNAPSHOT_SUFFIX, path + SNAPSHOT_SUFFIX + INDEX_SUFFIX, path + SNAPSHOT_SUFFIX + CHECKPOINT_SUFFIX,
+            path + SNAPSHOT_SUFFIX + QUERY_SUFFIX]
+
+
+_HEX_HASH = re.compile(r'[0-9a-f]{64}')
+
+
+def _pack_varint(n):
+    """Get a non-negative integer as a varint (7 bits per byte, low bits first)."""
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _unpack_varint(buf, pos):
+    """Read a varint from a position of a buffer; Return it and the next position."""
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _pack_str(s):
+    """Get a string as its length-prefixed utf-8 encoding."""
+    b = s.encode('utf-8')
+    return _pack_varint(len(b)) + b
+
+
+def _unpack_str(buf, pos):
+    """Read a length-prefixed string from a position of a buffer; Return it and the next position."""
+    n, pos = _unpack_varint(buf, pos)
+    if pos + n > len(buf):
+        raise ValueError("truncated string")
+    return bytes(buf[pos:pos + n]).decode('utf-8'), pos + n
+
+
+def _pack_hash(h):
+    """Get a hash as its 32 raw bytes, or any other string (such as the
+    previous hash of a genesis block) as it is."""
+    if _HEX_HASH.fullmatch(h):
+        return b'\x00' + bytes.fromhex(h)
+    return b'\x01' + _pack_str(h)
+
+
+def _unpack_hash(buf, pos):
+    """Read a hash from a position of a buffer; Return it and the next position."""
+    if buf[pos] == 0:
+        if pos + 33 > len(buf):
+            raise ValueError("truncated hash")
+        return bytes(buf[pos + 1:pos + 33]).hex(), pos + 33
+    return _unpack_str(buf, pos + 1)
+
+
+def unpack_block(buf):
+    """Create a block from its binary format."""
+    if len(buf) < _RECORD_LENGTH.size or _RECORD_LENGTH.unpack_from(buf, 0)[0] + _RECORD_LENGTH.size != len(buf):
+        raise ValueError("bad block length")
+    try:
+        index, pos = _unpack_varint(buf, _RECORD_LENGTH.size)
+        previous_hash, pos = _unpack_hash(buf, pos)
+    except IndexError:
+        raise ValueError("truncated block")
+    fields = json.loads(bytes(buf[pos:]).decode('utf-8'))
+    if not isinstance(fields, list) or len(fields) % 3 != 1:
+        raise ValueError("bad block fields")
+    it = iter(fields)
+    timestamp = next(it)
+    return Block(index, timestamp, [DataItem(j, ts, au, da) for j, (ts, au, da) in enumerate(zip(it, it, it))], previous_hash)
+
+
+def _encode_record(block, fmt):
+    """Get the record of a block in a block log of the specified format."""
+    if fmt == FORMAT_BIN:
+        return block.pack_me()
+    return (block.write_me(jsoned=True) + '\n').encode('utf-8')
+
+
+def _decode_record(record, fmt):
+    """Create a block from its record in a block log of the specified format."""
+    if fmt == FORMAT_BIN:
+        return unpack_block(record)
+    return load_block(record.decode('utf-8'))
+
+
+def _split_records(content, fmt, pos=0):
+    """Split the bytes of a block log, from the specified position, into its
+    complete records; Return the list of their offsets and bytes, and the
+    position where the last (incomplete) record starts."""
+    records = []
+    while pos < len(content):
+        if fmt == FORMAT_BIN:
+            if pos + 4 > len(content):
+                break
+            end = pos + 4 + int.from_bytes(content[pos:pos + 4], 'big')
+            if end > len(content):
+                break
+        else:
+            end = content.find(b'\n', pos) + 1
+            if end == 0:
+                break
+        records.append((pos, content[pos:end]))
+        pos = end
+    return records, pos
+
+
+def _block_from_dict(i, di):
+    """Create a block from its index and its dictionary."""
+    block = Block(int(i), di["ts"], [], di["ph"])
     num_data_items = len(di["da"])
     for j in range(num_data_items):
         dij = di["da"][str(j)]
         data_itemj = DataItem(j, dij["ts"], dij["au"], dij["da"])
-        block.data.update({j: data_itemj})
+        block.data.append(data_itemj)
     return block
 
 
-def load_blockchain(desc, only_genesis=False):
-    """Create a blockchain from a jsoned string."""
+def load_block(desc):
+    """Create a block from a jsoned string."""
     desc = json.loads(desc)
-    name = list(desc.keys())[0]
-    num_blocks = len(desc[name])
-    b0 = desc[name]["0"]
-    b0data_item0 = b0["da"]["0"]
-    blockchain = Blockchain(name, b0data_item0["au"], b0data_item0["da"])
-    block0 = blockchain.get_block(0)
-    block0.timestamp = b0["ts"]
-    block0.previous_hash = b0["ph"]
-    block0.get_data_item(0).timestamp = b0["ts"]
-    if only_genesis:
-        return blockchain
-    for i in range(1, num_blocks):
-        bi = desc[name][str(i)]
-        blocki = Block(i, bi["ts"], {}, bi["ph"])
-        num_data_items = len(bi["da"])
-        for j in range(num_data_items):
-            dij = bi["da"][str(j)]
-            data_itemj = DataItem(j, dij["ts"], dij["au"], dij["da"])
-            blocki.data.update({j: data_itemj})
-        blockchain.chain.update({i: blocki})
+    i = list(desc.keys())[0]
+    return _block_from_dict(i, desc[i])
+
+
+def iter_blocks(source, chunk_size=65536):
+    """Generate the header (as a dictionary) and then the blocks read one at a
+    time from a block log or a legacy single-JSON chain, given as a path, as a
+    file object (such as the file of a socket) or as an iterable of chunks."""
+    if isinstance(source, str):
+        with open(source, 'rb') as fin:
+            yield from iter_blocks(fin, chunk_size)
+        return
+    if hasattr(source, 'read'):
+        chunks = iter(lambda: source.read(chunk_size), b'')
+    else:
+        chunks = iter(source)
+    head = b''
+    for chunk in chunks:
+        head += chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+        if len(head) >= 10:
+            break
+    rest = [head]
+    if head.lstrip().startswith(b'{"bc0log"'):
+        yield from read_blocks(_chain_chunks(rest, chunks))
+    else:
+        yield from _read_legacy_blocks(_chain_chunks(rest, chunks))
+
+
+def _chain_chunks(first, chunks):
+    """Generate the chunks in first, then the other chunks."""
+    yield from first
+    yield from chunks
+
+
+def _read_legacy_blocks(chunks):
+    """Generate the header and then the blocks read one at a time from a
+    stream of chunks of a legacy single-JSON chain."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    state = {"buf": '', "pos": 0}
+
+    def more():
+        for chunk in chunks:
+            text = utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+            state["buf"] = state["buf"][state["pos"]:] + text
+            state["pos"] = 0
+            return True
+        return False
+
+    def peek():
+        while True:
+            buf, pos = state["buf"], state["pos"]
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            state["pos"] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not more():
+                raise ValueError("the chain has been truncated")
+
+    def expect(ch):
+        if peek() != ch:
+            raise ValueError("'" + ch + "' expected in the chain")
+        state["pos"] += 1
+
+    def value():
+        peek()
+        while True:
+            try:
+                v, state["pos"] = decoder.raw_decode(state["buf"], state["pos"])
+                return v
+            except ValueError:
+                if not more():
+                    raise
+
+    expect('{')
+    name = value()
+    expect(':')
+    expect('{')
+    yield {"name": name}
+    if peek() != '}':
+        while True:
+            i = value()
+            expect(':')
+            yield _block_from_dict(i, value())
+            if peek() != ',':
+                break
+            state["pos"] += 1
+    expect('}')
+    expect('}')
+
+
+@metrics.timed(OPERATION_SECONDS, op='load_blockchain')
+def load_blockchain(desc, only_genesis=False):
+    """Create a blockchain from a jsoned string (or a stream of chunks of it),
+    parsing a block at a time; the blocks are keyed by their indices, so that
+    a chain whose older blocks have been pruned keeps its base."""
+    blocks = _read_legacy_blocks([desc] if isinstance(desc, (str, bytes)) else desc)
+    header = next(blocks)
+    blockchain = Blockchain(header["name"])
+    blockchain._set_blocks([], 0)
+    for block in blocks:
+        if len(blockchain.chain) == 0:
+            blockchain._set_blocks([], block.index)
+        elif block.index != blockchain.get_num_blocks():
+            raise ValueError("block " + str(block.index) + " cannot follow block " + str(blockchain.get_num_blocks() - 1))
+        blockchain._put_block(block)
+        if only_genesis:
+            break
+    blockchain.detect_hash_version()
     return blockchain
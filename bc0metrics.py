@@ -0,0 +1,204 @@
+"""
+This file is part of BC0, Copyright 2018, Luca Mari.
+
+BC0 is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 2.
+
+BC0 is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License <http://www.gnu.org/licenses/> for more details.
+"""
+
+# Counters, gauges and latency histograms, exposed in the Prometheus text format
+import bisect
+import threading
+import time
+from functools import wraps
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'   # the Prometheus text format
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)   # seconds
+
+
+def _escape(value):
+    """Escape a label value."""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=''):
+    """Get the label set of a sample, as text."""
+    pairs = [n + '="' + _escape(v) + '"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """Handle a family of samples with the same name, one for each set of label values."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        """Class constructor: create a metric without samples."""
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}    # label values -> value
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        """Get the label values of a sample from the labels given by name."""
+        return tuple(labels[n] for n in self.labels)
+
+    def render(self):
+        """Get this metric in the Prometheus text format, as a list of lines."""
+        lines = ['# HELP ' + self.name + ' ' + self.doc, '# TYPE ' + self.name + ' ' + self.kind]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(self.name + _labels(self.labels, key) + ' ' + repr(value))
+        return lines
+
+
+class Counter(Metric):
+    """Handle a monotonically increasing count."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increase the sample with the specified labels."""
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Handle a value that can go up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the sample with the specified labels."""
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def clear(self):
+        """Remove all the samples."""
+        with self.lock:
+            self.values.clear()
+
+
+class Histogram(Metric):
+    """Handle the distribution of a duration in seconds, counted in buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        """Class constructor: create a histogram without samples."""
+        Metric.__init__(self, name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """Count a value in the sample with the specified labels."""
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]   # buckets, +Inf, sum
+            counts[i] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """Get a context manager observing the time spent in its block."""
+        return _Timer(self, labels)
+
+    def render(self):
+        """Get this histogram in the Prometheus text format, as a list of lines."""
+        lines = ['# HELP ' + self.name + ' ' + self.doc, '# TYPE ' + self.name + ' ' + self.kind]
+        with self.lock:
+            samples = sorted((key, list(counts)) for key, counts in self.values.items())
+        for key, counts in samples:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                le = 'le="' + (bound if bound == '+Inf' else repr(float(bound))) + '"'
+                lines.append(self.name + '_bucket' + _labels(self.labels, key, le) + ' ' + str(total))
+            lines.append(self.name + '_sum' + _labels(self.labels, key) + ' ' + repr(counts[-1]))
+            lines.append(self.name + '_count' + _labels(self.labels, key) + ' ' + str(total))
+        return lines
+
+
+class _Timer:
+    """Observe in a histogram the time spent in a with block."""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry:
+    """Handle the metrics exposed by a process."""
+
+    def __init__(self):
+        """Class constructor: create an empty registry."""
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, cls, name, doc, labels, **kwargs):
+        """Get the metric with the specified name, creating it if new."""
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, doc, labels, **kwargs)
+            return metric
+
+    def counter(self, name, doc, labels=()):
+        """Get a counter."""
+        return self._register(Counter, name, doc, labels)
+
+    def gauge(self, name, doc, labels=()):
+        """Get a gauge."""
+        return self._register(Gauge, name, doc, labels)
+
+    def histogram(self, name, doc, labels=(), buckets=BUCKETS):
+        """Get a histogram."""
+        return self._register(Histogram, name, doc, labels, buckets=buckets)
+
+    def render(self):
+        """Get all the metrics in the Prometheus text format."""
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()   # the metrics of this process
+
+
+def timed(histogram, **labels):
+    """Decorate a function so that its duration is observed in a histogram."""
+
+    def decorator(function):
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+
+        return wrapper
+
+    return decorator
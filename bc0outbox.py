@@ -0,0 +1,188 @@
+"""
+This file is part of BC0, Copyright 2018, Luca Mari.
+
+BC0 is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 2.
+
+BC0 is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License <http://www.gnu.org/licenses/> for more details.
+"""
+
+# Persistent queue of the updates to be sent to the peers of a host
+import asyncio
+import json
+import os
+import threading
+import time
+
+BACKOFF_MIN = 1.0       # seconds before retrying a failed send for the first time
+BACKOFF_MAX = 300.0     # maximum number of seconds between two retries
+WAKEUP_SLICE = 1.0      # maximum number of seconds a task draining the outbox waits for a wakeup at once
+
+
+class Outbox:
+    """Handle the updates waiting to be sent to each peer, for each blockchain;
+    the updates for the same peer and blockchain are coalesced, so that a
+    single send brings the peer up to date."""
+
+    def __init__(self, path, deliver, backoff_min=BACKOFF_MIN, backoff_max=BACKOFF_MAX):
+        """Class constructor: load the outbox stored in the specified file;
+        deliver(peer, chain_name, ops) must send the ops, raising on failure."""
+        self.path = path
+        self.deliver = deliver
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.entries = {}       # peer -> chain name -> entry
+        try:
+            with open(path, 'r') as fin:
+                self.entries = json.loads(fin.read())
+        except (OSError, ValueError):
+            pass
+        self.seq = max([e.get("seq", 0) for chains in self.entries.values() for e in chains.values()], default=0)
+
+    def put(self, peer, chain_name, req, data):
+        """Queue an update (a request with its data) for a peer;
+        an update to /append_block keeps the lowest height of the pending ones,
+        an update to /delete_remote_chain replaces all the pending ones,
+        membership deltas to /set_chain_hosts are merged, and
+        any other update replaces the pending one to the same request."""
+        with self.lock:
+            entry = self.entries.setdefault(peer, {}).setdefault(chain_name, {
+                "ops": [], "since": time.time(), "attempts": 0, "next": 0, "error": ""})
+            ops = entry["ops"]
+            if req == '/delete_remote_chain':
+                ops[:] = []
+            for op in ops:
+                if op[0] == req:
+                    if req == '/append_block' and op[1]["height"] <= data["height"]:
+                        break
+                    if req == '/set_chain_hosts' and "members" in op[1] and "members" in data:
+                        members = dict(op[1]["members"])
+                        for h, member in data["members"].items():
+                            if h not in members or member[0] > members[h][0]:
+                                members[h] = member
+                        data = dict(data, members=members)
+                    op[1] = data
+                    break
+            else:
+                ops.append([req, data])
+            self.seq += 1
+            entry["seq"] = self.seq
+            self._save()
+        self.wakeup.set()
+
+    def stats(self):
+        """Get the queue depth and the lag of each peer."""
+        now = time.time()
+        res = {}
+        with self.lock:
+            for peer, chains in self.entries.items():
+                res[peer] = {
+                    "depth": sum(len(e["ops"]) for e in chains.values()),
+                    "lag": round(now - min(e["since"] for e in chains.values()), 3) if chains else 0,
+                    "attempts": max((e["attempts"] for e in chains.values()), default=0),
+                    "next_try": round(max(0, min((e["next"] for e in chains.values()), default=0) - now), 3),
+                    "error": "; ".join(e["error"] for e in chains.values() if e["error"])
+                }
+        return res
+
+    def drain(self, pool=None):
+        """Send the updates that are due, in parallel if a pool is specified;
+        Return the number of seconds until the next update is due."""
+        due = self._due()
+        if pool is None:
+            results = [self._deliver(*d[:3]) for d in due]
+        else:
+            results = list(pool.map(lambda d: self._deliver(*d[:3]), due))
+        return self._settle(due, results)
+
+    async def drain_async(self, deliver):
+        """Send the updates that are due, concurrently on the running event loop,
+        with deliver(peer, chain_name, ops) a coroutine function raising on failure;
+        Return the number of seconds until the next update is due."""
+        loop = asyncio.get_running_loop()
+        due = self._due()
+        results = await asyncio.gather(*[self._deliver_async(deliver, *d[:3]) for d in due])
+        return await loop.run_in_executor(None, self._settle, due, results)
+
+    def run(self, pool=None):
+        """Drain this outbox forever (to be called in a background thread)."""
+        while True:
+            wait = self.drain(pool)
+            self.wakeup.wait(timeout=wait)
+            self.wakeup.clear()
+
+    async def run_async(self, deliver):
+        """Drain this outbox forever on the running event loop (to be run as a task)."""
+        loop = asyncio.get_running_loop()
+        while True:
+            wait = await self.drain_async(deliver)
+            # the wakeup comes from any thread: wait for it in a thread, a slice at a time
+            await loop.run_in_executor(None, self.wakeup.wait, WAKEUP_SLICE if wait is None else min(wait, WAKEUP_SLICE))
+            self.wakeup.clear()
+
+    def start(self, pool=None):
+        """Start draining this outbox in a background thread."""
+        thread = threading.Thread(target=self.run, args=(pool,), name='outbox', daemon=True)
+        thread.start()
+        return thread
+
+    def _due(self):
+        """Get the updates that are due, with the sequence numbers they have now."""
+        now = time.time()
+        with self.lock:
+            return [(peer, name, [list(op) for op in e["ops"]], e["seq"]) for peer, chains in self.entries.items()
+                    for name, e in chains.items() if e["next"] <= now]
+
+    def _settle(self, due, results):
+        """Remove the updates that have been sent, and schedule again the failed ones;
+        Return the number of seconds until the next update is due."""
+        with self.lock:
+            for (peer, name, ops, seq), error in zip(due, results):
+                entry = self.entries.get(peer, {}).get(name)
+                if entry is None:
+                    continue
+                if error is None:
+                    if entry["seq"] == seq:
+                        del self.entries[peer][name]
+                        if len(self.entries[peer]) == 0:
+                            del self.entries[peer]
+                    else:       # updated in the meantime: send it again
+                        entry.update({"attempts": 0, "next": 0, "error": ""})
+                else:
+                    delay = min(self.backoff_min * 2 ** entry["attempts"], self.backoff_max)
+                    entry.update({"attempts": entry["attempts"] + 1, "next": time.time() + delay, "error": error})
+            if len(due) > 0:
+                self._save()
+            pending = [e["next"] for chains in self.entries.values() for e in chains.values()]
+        return max(0, min(pending) - time.time()) if pending else None
+
+    def _deliver(self, peer, chain_name, ops):
+        """Send the updates, getting None if ok or the error."""
+        try:
+            self.deliver(peer, chain_name, ops)
+            return None
+        except Exception as e:
+            return type(e).__name__ + ': ' + str(e)
+
+    async def _deliver_async(self, deliver, peer, chain_name, ops):
+        """Send the updates with a coroutine function, getting None if ok or the error."""
+        try:
+            await deliver(peer, chain_name, ops)
+            return None
+        except Exception as e:
+            return type(e).__name__ + ': ' + str(e)
+
+    def _save(self):
+        """Durably write this outbox to its file."""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fout:
+            fout.write(json.dumps(self.entries))
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp, self.path)
@@ -0,0 +1,211 @@
+"""
+This file is part of BC0, Copyright 2018, Luca Mari.
+
+BC0 is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 2.
+
+BC0 is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License <http://www.gnu.org/licenses/> for more details.
+"""
+
+# Tests of the endpoints of the server, with the test client of flask
+import itertools
+import json
+import sys
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_wtf')
+pytest.importorskip('requests')
+
+import bc0lib as bc
+import bc0outbox
+from test_bc0lib import make_blocks
+
+
+@pytest.fixture(scope='module')
+def server_module():
+    """Get the module of the server, imported without the arguments of pytest."""
+    with mock.patch.object(sys, 'argv', sys.argv[:1]):
+        import bc0
+    return bc0
+
+
+@pytest.fixture
+def server(server_module, tmp_path, monkeypatch):
+    """Get the module of the server, with its files in a temporary folder and a block sealed for each data item."""
+    monkeypatch.setattr(server_module, 'app_folder', str(tmp_path))
+    monkeypatch.setattr(server_module, 'outbox', bc0outbox.Outbox(str(tmp_path / 'outbox'), server_module.deliver_ops))
+    monkeypatch.setitem(server_module.app.config, 'BC0_SEAL_MAX_ITEMS', 1)
+    return server_module
+
+
+def login(server, userid):
+    """Get a test client with a user logged in."""
+    client = server.app.test_client()
+    client.post('/login', data={'userid': userid})
+    return client
+
+
+def test_concurrent_add_data(server, tmp_path):
+    """Data added at the same time by several clients all end up in the chain, in blocks linked to each other."""
+    login(server, 'owner').post('/create_chain', data={'name': 'c'})
+    errors = []
+
+    def add(k):
+        client = login(server, 'user' + str(k))
+        for r in range(5):
+            res = client.post('/add_data', data={'name': 'c', 'data': 'data ' + str(k) + ' ' + str(r)})
+            if res.status_code != 200: errors.append(res.status_code)
+
+    threads = [threading.Thread(target=add, args=(k,)) for k in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert errors == []
+    path = str(tmp_path / 'c_localhost_chain')
+    chain = bc.Blockchain.open(path)
+    authors = [chain.get_block(b).get_data_item(i).author for b in range(1, chain.get_num_blocks())
+               for i in range(chain.get_block(b).get_num_data_items())]
+    assert sorted(authors) == sorted('user' + str(k) for k in range(8) for _ in range(5))
+    assert bc.verify_chain(path) == -1
+    res = json.loads(server.app.test_client().get('/query?name=c&author=user3').data)
+    assert res['code'] == '0' and res['data']['total'] == 5
+
+
+def test_blocks_endpoints(server):
+    """The blocks streamed by a host can be sent back to it, and blocks beyond its chain are refused."""
+    client = login(server, 'owner')
+    client.post('/create_chain', data={'name': 'c'})
+    for r in range(3):
+        client.post('/add_data', data={'name': 'c', 'data': 'data ' + str(r)})
+    res = client.get('/get_blocks?name=c&from=1', headers={'Accept': server.BIN_MIMETYPE})
+    blocks = bc.read_blocks([res.data])
+    assert next(blocks)['to'] == 4
+    assert [b.index for b in blocks] == [1, 2, 3]
+    chain = bc.Blockchain.open(str(server.app_folder) + '/c_localhost_chain')
+    res = client.post('/append_block', data=server.blocks_to_pack(chain, 1), content_type=server.BIN_MIMETYPE)
+    assert json.loads(res.data) == {'code': '0', 'added': 0}
+    data = server.blocks_to_send(chain, 2)
+    data['height'] = 6
+    res = client.post('/append_block', data=json.dumps(data), content_type='application/json')
+    assert json.loads(res.data) == {'code': '-3', 'from': 4}
+    assert client.get('/get_blocks?name=missing').status_code == 404
+
+
+def test_merge_members(server):
+    """The deltas of a membership merged in any order, including a leave and then a re-entry, give the same membership."""
+    deltas = [{'b': [1, True]}, {'b': [2, False]}, {'b': [3, True], 'c': [1, True]}, {'c': [2, False]}]
+    for order in itertools.permutations(deltas):
+        members = {'a': [0, True]}
+        for delta in order:
+            server.merge_members(members, delta)
+        assert members == {'a': [0, True], 'b': [3, True], 'c': [2, False]}
+        assert server.hosts_data(members)['hosts'] == ['a', 'b']
+        assert server.merge_members(members, {'b': [2, False]}) == {}
+
+
+def test_gossip_forwards_new_updates(server, tmp_path, monkeypatch):
+    """In gossip mode a membership delta, a block or a deletion is forwarded only the first time it is received."""
+    sent = []
+    monkeypatch.setattr(server, 'spread_update', lambda bc_name, host_list, bc_host, req, data: sent.append(req))
+    monkeypatch.setitem(server.app.config, 'BC0_GOSSIP', True)
+    client = login(server, 'owner')
+    client.post('/create_chain', data={'name': 'c'})
+    delta = json.dumps({'name': 'c', 'members': {'peer:5000': [1, True]}})
+    assert [client.post('/set_chain_hosts', data=delta).data for _ in range(2)] == [b'0', b'0']
+    assert sent == ['/set_chain_hosts']
+    chain = bc.load_blockchain(bc.Blockchain.open(str(tmp_path / 'c_localhost_chain')).write_me(jsoned=True))
+    chain.append_blocks(make_blocks(chain, 2))
+    data = json.dumps(server.blocks_to_send(chain, 1))
+    added = [json.loads(client.post('/append_block', data=data, content_type='application/json').data)['added'] for _ in range(2)]
+    assert added == [2, 0]
+    assert sent == ['/set_chain_hosts', '/append_block']
+    assert [client.post('/delete_remote_chain', data=json.dumps({'name': 'c'})).data for _ in range(2)] == [b'0', b'0']
+    assert sent == ['/set_chain_hosts', '/append_block', '/delete_remote_chain']
+
+
+def test_content_pages(server):
+    """The content page shows the host, and arguments that are not integers are refused with an error code."""
+    client = login(server, 'owner')
+    client.post('/create_chain', data={'name': 'c'})
+    res = client.post('/show_content', data={'name': 'c', 'page': '0'})
+    assert b'Connected as host ' + server.hostid.encode('utf-8') in res.data
+    assert b'Please specify the number of a page' in client.post('/show_content', data={'name': 'c', 'page': 'x'}).data
+    for url in ('/chain_content?name=c&page=x', '/chain_content?name=c&to=1.5', '/get_blocks?name=c&from=x',
+                '/get_proof?name=c&block=x', '/query?name=c&size=x'):
+        res = client.get(url)
+        assert (res.status_code, json.loads(res.data)) == (400, {'code': '-2'})
+    assert json.loads(client.get('/chain_content?name=c&page=0').data)['code'] == '0'
+
+
+def test_get_proof(server, tmp_path):
+    """The proof of a data item links it to the headers of the blocks up to the requested one, for merkle chains only."""
+    client = login(server, 'owner')
+    client.post('/create_chain', data={'name': 'c'})
+    for r in range(3):
+        client.post('/add_data', data={'name': 'c', 'data': 'data ' + str(r)})
+    res = json.loads(client.get('/get_proof?name=c&block=1&item=0&to=3').data)
+    assert res['code'] == '0'
+    proof = res['data']
+    block_hash = bc.check_proof(proof['item'], proof['path'], proof['headers'][0])
+    for header in proof['headers'][1:]:
+        assert header[1] == block_hash
+        block_hash = bc.hasher.sha256(bc._canonical(header)).hexdigest()
+    assert block_hash == bc.Blockchain.open(str(tmp_path / 'c_localhost_chain')).get_block(3).hash_me()
+    assert json.loads(client.get('/get_proof?name=c&block=1&item=5').data) == {'code': '-1'}
+    bc.Blockchain('old', 'me', hash_version=bc.HASH_CANONICAL).save(str(tmp_path / 'old_localhost_chain'))
+    assert json.loads(client.get('/get_proof?name=old&block=0&item=0').data) == {'code': '-3'}
+
+
+def test_upgrade_to_pruned_chain(server, tmp_path):
+    """A pruned chain sent as a whole replaces the local chain with its base, and the next block follows it."""
+    client = login(server, 'owner')
+    client.post('/create_chain', data={'name': 'c'})
+    chain = bc.Blockchain('c', 'me')
+    chain.append_blocks(make_blocks(chain, 5))
+    chain.forget_blocks(5)
+    assert client.post('/upgrade_chain', data=json.dumps({'name': 'c', 'data': chain.write_me(jsoned=True)})).data == b'0'
+    client.post('/add_data', data={'name': 'c', 'data': 'data'})
+    local = bc.Blockchain.open(str(tmp_path / 'c_localhost_chain'))
+    assert (local.base, local.get_num_blocks()) == (5, 7)
+    assert local.get_block(6).previous_hash == chain.get_block(5).hash_me()
+
+
+def test_download_ranges(server, tmp_path, monkeypatch):
+    """A chain is downloaded from several peers even if one is too slow and another sends blocks not linked to it."""
+    source = bc.Blockchain('test', 'me')
+    source.save(str(tmp_path / 'local_chain'))
+    local = bc.Blockchain.open(str(tmp_path / 'local_chain'))
+    source.save(str(tmp_path / 'source_chain'))
+    source.append_blocks(make_blocks(source, 40))
+    other = bc.Blockchain('other', 'me')
+    other.save(str(tmp_path / 'other_chain'))
+    other.append_blocks(make_blocks(other, 40))
+    started = {'slow': threading.Event(), 'forged': threading.Event()}
+
+    def fetch_range(host, bc_name, first, last, hash_version):
+        if host in started: started[host].set()
+        if host == 'slow':
+            time.sleep(2.0)
+        else:
+            started['slow'].wait(1.0)
+            started['forged'].wait(1.0)
+        view = bc.BlockLogView(str(tmp_path / ('other_chain' if host == 'forged' else 'source_chain')))
+        return [view.get_block(i) for i in range(first, last)]
+
+    monkeypatch.setattr(server, 'fetch_range', fetch_range)
+    monkeypatch.setitem(server.app.config, 'BC0_SYNC_BATCH', 5)
+    monkeypatch.setitem(server.app.config, 'BC0_SYNC_TIMEOUT', 0.3)
+    start = time.perf_counter()
+    assert server.download_ranges(local, ['slow', 'forged', 'good'], 'test', 41) == 41
+    assert time.perf_counter() - start < 1.5
+    local = bc.BlockLogView(str(tmp_path / 'local_chain'))    # the downloaded blocks are not kept in memory
+    assert [local.get_block(i).hash_me() for i in range(41)] == [source.get_block(i).hash_me() for i in range(41)]
+    assert bc.verify_chain(str(tmp_path / 'local_chain')) == -1
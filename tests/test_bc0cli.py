@@ -0,0 +1,29 @@
+"""
+This file is part of BC0, Copyright 2018, Luca Mari.
+
+BC0 is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 2.
+
+BC0 is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License <http://www.gnu.org/licenses/> for more details.
+"""
+
+# Tests of the command line tools
+import bc0cli
+import bc0lib as bc
+
+
+def test_import_csv(tmp_path, capsys):
+    """The rows of a csv input are imported, and a csv input without the author column is refused with its line."""
+    chain = str(tmp_path / 'c_host_chain')
+    good = tmp_path / 'good.csv'
+    good.write_text('author,data\nann,one\nbob,two\n')
+    assert bc0cli.main(['import', chain, str(good), '--block-items', '1', '--quiet']) == 0
+    assert bc.Blockchain.open(chain).get_num_blocks() == 3
+    bad = tmp_path / 'bad.csv'
+    bad.write_text('who,data\nann,one\n')
+    assert bc0cli.main(['import', chain, str(bad), '--quiet']) == 2
+    assert 'line 2: not a csv row with the field "author"' in capsys.readouterr().err
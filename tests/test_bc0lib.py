@@ -0,0 +1,312 @@
+"""
+This file is part of BC0, Copyright 2018, Luca Mari.
+
+BC0 is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 2.
+
+BC0 is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License <http://www.gnu.org/licenses/> for more details.
+"""
+
+# Tests of the blockchain library
+import datetime as date
+import json
+import threading
+import time
+
+import pytest
+
+import bc0lib as bc
+
+
+def make_blocks(chain, n, items=1):
+    """Get n new blocks following the last block of a chain."""
+    blocks = []
+    tip = chain.get_block(chain.get_num_blocks() - 1)
+    for _ in range(n):
+        data = [bc.DataItem(i, str(date.datetime.now()), 'author' + str(i), 'data ' + str(i)) for i in range(items)]
+        tip = bc.Block(tip.index + 1, date.datetime.now(), data, tip.hash_me(), chain.hash_version)
+        blocks.append(tip)
+    return blocks
+
+
+def new_chain(tmp_path, n=0, fmt=bc.FORMAT_JSON):
+    """Get a chain with n blocks after the genesis block, saved in a block log."""
+    path = str(tmp_path / 'test_host_chain')
+    chain = bc.Blockchain('test', 'me')
+    chain.save(path, fmt)
+    chain.append_blocks(make_blocks(chain, n))
+    return path, chain
+
+
+def test_hash_kept_until_block_changes(tmp_path):
+    """Appending blocks already hashed, with the hash version of the chain, does not hash them again."""
+    _, chain = new_chain(tmp_path)
+    blocks = make_blocks(chain, 100)
+    hashed = bc.HASH_OPS.values.get(('block',), 0)
+    chain.append_blocks(blocks)
+    assert chain.check_me() == -1
+    assert bc.HASH_OPS.values.get(('block',), 0) == hashed
+    blocks[50].hash_version = bc.HASH_CANONICAL
+    blocks[50].timestamp = blocks[50].timestamp
+    assert blocks[50].hash_me() != blocks[51].previous_hash
+    blocks[50].hash_version = chain.hash_version
+    assert blocks[50].hash_me() == blocks[51].previous_hash
+
+
+def test_cache_refresh_during_append(tmp_path, monkeypatch):
+    """A reader refreshing a cached chain while a writer appends to it does not load the new blocks twice."""
+    path, _ = new_chain(tmp_path, 1)
+    cache = bc.FileCache()
+    chain = cache.get(path, bc.Blockchain.open, bc.Blockchain.refresh)
+    appending = threading.Event()
+    append_file = bc._append_file
+
+    def slow_append_file(p, data):      # the log has been written, its index not yet
+        appending.set()
+        time.sleep(0.1)
+        append_file(p, data)
+
+    monkeypatch.setattr(bc, '_append_file', slow_append_file)
+    reader = threading.Thread(target=lambda: appending.wait() and cache.get(path, bc.Blockchain.open, bc.Blockchain.refresh))
+    reader.start()
+    chain.append_blocks(make_blocks(chain, 1))
+    reader.join()
+    assert [chain.get_block(i).index for i in range(chain.get_num_blocks())] == [0, 1, 2]
+    assert cache.get(path, bc.Blockchain.open, bc.Blockchain.refresh) is chain
+    assert chain.get_num_blocks() == bc.Blockchain.open(path).get_num_blocks() == 3
+
+
+def test_tail_and_refresh_read_end_of_index(tmp_path, monkeypatch):
+    """Opening the tail of a chain, and refreshing a chain or a view, read only the end of the index."""
+    path, chain = new_chain(tmp_path, 50)
+    view = bc.BlockLogView(path)
+    starts = []
+    read_offsets = bc._read_offsets
+    monkeypatch.setattr(bc, '_read_offsets', lambda p, start=0: starts.append(start) or read_offsets(p, start))
+    tail = bc.Blockchain.open(path, tail=True)
+    assert (tail.base, tail.get_num_blocks()) == (50, 51)
+    chain.append_blocks(make_blocks(chain, 3))
+    assert tail.refresh() and tail.get_num_blocks() == 54
+    assert tail.get_block(53).hash_me() == chain.get_block(53).hash_me()
+    tail.append_blocks(make_blocks(tail, 1))
+    assert chain.refresh() and chain.get_num_blocks() == 55
+    assert view.refresh() and view.get_block(54).hash_me() == tail.get_block(54).hash_me()
+    assert starts == [-1, 50, 53, 50]
+    assert chain.check_me() == -1
+
+
+def test_concurrent_readers_and_writer(tmp_path):
+    """Readers of a cached chain always see the blocks on disk, each once."""
+    path, _ = new_chain(tmp_path)
+    cache = bc.FileCache()
+    chain = cache.get(path, bc.Blockchain.open, bc.Blockchain.refresh)
+    done = threading.Event()
+    errors = []
+
+    def read():
+        while not done.is_set():
+            c = cache.get(path, bc.Blockchain.open, bc.Blockchain.refresh)
+            indexes = [c.get_block(i).index for i in range(c.base, c.get_num_blocks())]
+            if indexes != list(range(c.base, c.get_num_blocks())):
+                errors.append(indexes)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for r in readers:
+        r.start()
+    try:
+        for _ in range(50):
+            chain.append_blocks(make_blocks(chain, 2))
+    finally:
+        done.set()
+        for r in readers:
+            r.join()
+    assert errors == []
+    assert chain.check_me() == -1
+    assert cache.get(path, bc.Blockchain.open, bc.Blockchain.refresh).get_num_blocks() == 101
+
+
+def test_checkpoint_and_snapshot(tmp_path):
+    """A verified chain gets a checkpoint signed with the key, and its snapshot keeps only the blocks from there on."""
+    path, chain = new_chain(tmp_path, 10)
+    assert bc.verify_chain(path, workers=1, key='key') == -1
+    assert bc.read_checkpoint(path, 'key') == (10, chain.get_block(10).hash_me())
+    assert bc.read_checkpoint(path, 'another key') is None      # a checkpoint signed with another key is not trusted
+    chain.append_blocks(make_blocks(chain, 3))
+    assert bc.take_snapshot(path, 'key') == path + bc.SNAPSHOT_SUFFIX
+    bc.install_snapshot(path)
+    pruned = bc.Blockchain.open(path)
+    assert (pruned.base, pruned.get_num_blocks()) == (10, 14)
+    assert pruned.get_block(13).hash_me() == chain.get_block(13).hash_me()
+    assert bc.verify_chain(path, workers=1, key='key') == -1
+
+
+def test_pruned_chain_as_json(tmp_path):
+    """A chain whose older blocks have been pruned keeps its base when sent as a single json."""
+    _, chain = new_chain(tmp_path, 5)
+    chain.forget_blocks(5)
+    received = bc.load_blockchain(chain.write_me(jsoned=True))
+    assert (received.base, received.get_num_blocks(), received.get_block(5).index) == (5, 6, 5)
+    assert received.get_block(5).hash_me() == chain.get_block(5).hash_me()
+    assert received.add_block(date.datetime.now()).index == 6
+    assert received.check_me() == -1
+
+
+def test_merkle_proofs(tmp_path):
+    """The proof of each data item of blocks with odd and even numbers of items checks, and not if the item or a sibling is tampered."""
+    _, chain = new_chain(tmp_path)
+    for items in range(1, 8):
+        block = make_blocks(chain, 1, items)[0]
+        header = block.get_header()
+        for i in range(items):
+            item = block.get_data_item(i).dump_me()
+            path = block.get_proof(i)
+            assert bc.check_proof(item, path, header) == block.hash_me()
+            assert bc.check_proof(dict(item, da=item['da'] + '!'), path, header) is None
+            for k in range(len(path)):
+                tampered = [list(p) for p in path]
+                tampered[k][1] = bc.hasher.sha256(b'tampered').hexdigest()
+                assert bc.check_proof(item, tampered, header) is None
+        if items == 3:      # the third item has no sibling at the leaves, and is promoted
+            assert (len(block.get_proof(0)), len(block.get_proof(2))) == (2, 1)
+    assert block.get_proof(7) is None
+
+
+def test_load_legacy_chain_by_chunks(tmp_path):
+    """A legacy single-json chain parsed a block at a time, from chunks of any size, hashes as when parsed at once."""
+    _, chain = new_chain(tmp_path)
+    chain.append_blocks(make_blocks(chain, 3, items=2))
+    tip = chain.get_block(3)
+    chain.append_block(bc.Block(4, date.datetime.now(), [bc.DataItem(0, 'now', 'mé', {'text': 'é "quoted" € \U0001d11e', 'n': [1, 2]})], tip.hash_me()))
+    for indented in (False, True):
+        text = chain.write_me(jsoned=True, indented=indented)
+        desc = json.loads(text)     # parsed at once, as the chain files used to be
+        expected = [bc._block_from_dict(i, d) for i, d in desc['test'].items()]
+        for block in expected:
+            block.hash_version = chain.hash_version
+        content = text.encode('utf-8')
+        for size in (1, 2, 3, 7, len(content)):
+            loaded = bc.load_blockchain(content[k:k + size] for k in range(0, len(content), size))
+            assert loaded.name == 'test' and loaded.hash_version == chain.hash_version
+            assert [loaded.get_block(i).hash_me() for i in range(loaded.get_num_blocks())] == [b.hash_me() for b in expected]
+        for cut in range(1, len(content), 5):
+            with pytest.raises(ValueError):
+                bc.load_blockchain([content[:cut]])
+
+
+def test_log_formats(tmp_path):
+    """Blocks read back from a block log, or streamed in another format, hash as the original ones."""
+    _, chain = new_chain(tmp_path)
+    chain.append_blocks(make_blocks(chain, 2, items=3))
+    tip = chain.get_block(2)
+    chain.append_block(bc.Block(3, date.datetime.now(), [bc.DataItem(0, 'now', 'me', {'n': 1, 'text': 'é "quoted" €'})], tip.hash_me()))
+    chain.append_blocks(make_blocks(chain, 2, items=3))
+    hashes = [chain.get_block(i).hash_me() for i in range(chain.get_num_blocks())]
+    record = chain.get_block(3).pack_me()     # the previous hash is stored as raw bytes
+    assert bytes.fromhex(hashes[2]) in record and hashes[2].encode('ascii') not in record
+    for fmt in (bc.FORMAT_JSON, bc.FORMAT_BIN):
+        path = str(tmp_path / (fmt + '_chain'))
+        chain.save(path, fmt)
+        assert [b.hash_me() for b in bc.Blockchain.open(path).chain] == hashes
+        for wire in (bc.FORMAT_JSON, bc.FORMAT_BIN):
+            received = bc.read_blocks(bc.stream_blocks(path, fmt=wire))
+            header = next(received)
+            assert bc.log_format(header) == wire
+            for block in received:
+                block.hash_version = chain.hash_version
+                assert block.hash_me() == hashes[block.index]
+        tail = bc.Blockchain.open(path, tail=True)
+        tail.append_blocks(make_blocks(tail, 2))
+        assert bc.verify_chain(path, workers=1) == -1
+        assert bc.Blockchain.open(path).get_num_blocks() == 8
+
+
+def test_verify_chain_in_processes(tmp_path):
+    """A chain is verified by a long-lived pool of processes, which report the hashes they compute."""
+    path, chain = new_chain(tmp_path, 20)
+    hashed = bc.HASH_OPS.values.get(('block',), 0)
+    assert bc.verify_chain(path, workers=2, chunk_size=4) == -1
+    assert bc.HASH_OPS.values.get(('block',), 0) - hashed == 21
+    pool = bc.verify_pool(2)
+    with open(path, 'r+b') as f:        # corrupt the data of block 10
+        content = f.read()
+        f.seek(content.index(b'data 0', bc.BlockLogView(path)._offsets[10]))
+        f.write(b'DATA')
+    assert bc.verify_chain(path, workers=2, chunk_size=4) == 10
+    assert bc.verify_pool(2) is pool
+
+
+def test_mempool_sealing_policy(tmp_path):
+    """The data items of a mempool are due to be sealed when they are enough, large enough or old enough."""
+    path, _ = new_chain(tmp_path)
+    pool = bc.Mempool(path)
+    assert not pool.is_due(1, 1, 0.0)      # nothing to seal
+    pool.add_data('me', 'data 0')
+    pool.add_data('me', 'data 1')
+    assert not pool.is_due(3, 1000, 60.0)
+    assert pool.is_due(2, 1000, 60.0)
+    assert pool.is_due(3, pool.size, 60.0)
+    pool.items[0].timestamp = (date.datetime.now() - date.timedelta(seconds=61)).isoformat()
+    assert pool.is_due(3, 1000, 60.0)
+
+
+def test_mempool_sealed_before_a_crash(tmp_path):
+    """A mempool whose data items had been sealed before a crash, but not emptied, is emptied and not sealed again."""
+    path, chain = new_chain(tmp_path)
+    pool = bc.Mempool(path)
+    pool.add_data('me', 'data 0')
+    pool.add_data('you', {'text': 'data 1'})
+    with open(path + bc.POOL_SUFFIX, 'rb') as fin:
+        content = fin.read()
+    assert pool.seal(chain, date.datetime.now()).index == 1
+    with open(path + bc.POOL_SUFFIX, 'wb') as fout:
+        fout.write(content)         # as if the server stopped before emptying the mempool
+    pool = bc.Mempool(path)
+    assert pool.get_num_data_items() == 2
+    chain = bc.Blockchain.open(path)
+    assert pool.seal(chain, date.datetime.now()) is None
+    assert chain.get_num_blocks() == 2 and bc.Blockchain.open(path).get_num_blocks() == 2
+    assert bc.Mempool(path).get_num_data_items() == 0
+
+
+def test_group_commit():
+    """A request alone is committed at once, and concurrent ones are committed together."""
+    calls = []
+
+    def commit(key, requests):
+        calls.append(list(requests))
+        time.sleep(0.05)
+        return [r * 10 for r in requests]
+
+    committer = bc.GroupCommit(commit, window=0.5)
+    start = time.perf_counter()
+    assert committer.submit('c', 1) == 10
+    assert time.perf_counter() - start < 0.5
+    results = {}
+    threads = [threading.Thread(target=lambda r=r: results.update({r: committer.submit('c', r)})) for r in range(2, 10)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert results == {r: r * 10 for r in range(2, 10)}
+    assert committer.stats() == {'commits': len(calls), 'requests': 9} and len(calls) < 9
+    assert committer.active == {}
+
+
+def test_query_index(tmp_path):
+    """The pages of the data items in a range of block timestamps, by any author or by one, are those of a scan."""
+    path, chain = new_chain(tmp_path)
+    for items in (3, 0, 1, 4, 2, 0, 5):
+        chain.append_blocks(make_blocks(chain, 1, items))
+    index = bc.ItemIndex.open(path)
+    blocks = [chain.get_block(k) for k in range(chain.get_num_blocks())]
+    times = [b.timestamp for b in blocks]
+    for author in (None, 'author1'):
+        for since, until in ((None, None), (times[2], None), (None, times[5]), (times[1], times[7])):
+            found = [(b.index, i) for b in blocks for i in range(b.get_num_data_items())
+                     if (since is None or b.timestamp >= since) and (until is None or b.timestamp < until)
+                     and author in (None, b.get_data_item(i).author)]
+            for offset in range(len(found) + 2):
+                for limit in (1, 2, 5, 100):
+                    assert index.find(author, since, until, offset, limit) == (len(found), found[offset:offset + limit])
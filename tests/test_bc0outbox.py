@@ -0,0 +1,43 @@
+"""
+This file is part of BC0, Copyright 2018, Luca Mari.
+
+BC0 is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 2.
+
+BC0 is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License <http://www.gnu.org/licenses/> for more details.
+"""
+
+# Tests of the outbox of the updates to the peers
+import asyncio
+
+import bc0outbox
+
+
+def test_drain_async(tmp_path):
+    """The updates are sent concurrently on the event loop, and the failed ones are kept for a retry."""
+    sent = []
+    running = {'now': 0, 'max': 0}
+
+    async def deliver(peer, chain_name, ops):
+        running['now'] += 1
+        running['max'] = max(running['max'], running['now'])
+        await asyncio.sleep(0.05)
+        running['now'] -= 1
+        if peer == 'down:5000': raise OSError('unreachable')
+        sent.append((peer, chain_name, [op[0] for op in ops]))
+
+    outbox = bc0outbox.Outbox(str(tmp_path / 'outbox'), None)
+    for peer in ('a:5000', 'b:5000', 'down:5000'):
+        outbox.put(peer, 'c', '/append_block', {'height': 3})
+        outbox.put(peer, 'c', '/append_block', {'height': 5})   # coalesced with the pending one
+    wait = asyncio.run(outbox.drain_async(deliver))
+    assert sorted(sent) == [('a:5000', 'c', ['/append_block']), ('b:5000', 'c', ['/append_block'])]
+    assert running['max'] == 3
+    assert 0 < wait <= bc0outbox.BACKOFF_MIN
+    stats = outbox.stats()
+    assert list(stats) == ['down:5000'] and 'unreachable' in stats['down:5000']['error']
+    assert bc0outbox.Outbox(str(tmp_path / 'outbox'), None).stats().keys() == stats.keys()     # stored durably